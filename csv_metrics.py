@@ -6,8 +6,19 @@ to a CSV file."""
 import argparse
 import csv
 import getpass
-from datetime import datetime, timezone
+import json
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from fnmatch import fnmatch
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import groupby, product
+from os import replace
+from os.path import exists
 
+import numpy as np
 import requests
 import urllib3
 from avi.sdk.avi_api import ApiSession
@@ -25,6 +36,610 @@ SECONDS_PER_MINUTE = 60
 SECONDS_PER_HOUR = 60 * SECONDS_PER_MINUTE
 SECONDS_PER_DAY = 24 * SECONDS_PER_HOUR
 
+BATCH_SIZE = 20
+WORKERS = 4
+CHUNK_POINTS = 720
+NAME_CACHE_TTL = '1d'
+EXPORTER_INTERVAL = 60
+EXPORTER_HOST = '127.0.0.1'
+OPENMETRICS_CONTENT_TYPE = ('application/openmetrics-text; version=1.0.0; '
+                            'charset=utf-8')
+
+
+def parse_timespan(timespan):
+    """Convert a timespan in seconds, or with an m(inutes), h(ours) or
+    d(ays) suffix, to a number of seconds."""
+    if timespan[-1] == 'm':
+        return int(timespan[:-1]) * SECONDS_PER_MINUTE
+    if timespan[-1] == 'h':
+        return int(timespan[:-1]) * SECONDS_PER_HOUR
+    if timespan[-1] == 'd':
+        return int(timespan[:-1]) * SECONDS_PER_DAY
+    return int(timespan)
+
+
+def parse_timestamp(timestamp):
+    """Parse an ISO8601 timestamp, assuming UTC if it has no timezone."""
+    dt = datetime.fromisoformat(timestamp)
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+class MetricsCache:
+    """A local on-disk cache of previously retrieved metrics data, so that
+    repeated runs over the same trailing window only need to retrieve the
+    data points added since the previous run.
+
+    Data is cached per controller, tenant, metric and set of request
+    parameters (entity, pool, granularity, object ID etc.). Data points
+    older than the retention period are evicted, as are entries that have
+    not been updated within the retention period."""
+
+    def __init__(self, filename, prefix, retention):
+        self.filename = filename
+        self.prefix = prefix
+        self.retention = timedelta(seconds=retention)
+        self.entries = {}
+        if exists(filename):
+            with open(filename, 'r', encoding='UTF-8') as cache_file:
+                self.entries = json.load(cache_file)
+
+    def key(self, request, metric_id):
+        params = {k: v for k, v in request.items()
+                  if k not in ('id', 'stop', 'limit', 'metric_id')}
+        return json.dumps([self.prefix, metric_id, params], sort_keys=True)
+
+    def cached_metrics(self, request):
+        """Return the cached metrics for a request, or None unless data for
+        all of the request's metrics is cached."""
+        metrics = []
+        for metric_id in request['metric_id'].split(','):
+            entry = self.entries.get(self.key(request, metric_id))
+            if not entry:
+                return None
+            metrics.extend(entry['metrics'])
+        return metrics
+
+    def trim_request(self, request):
+        """Return a copy of a metric request with its limit reduced to cover
+        only the data points since the last cached timestamp common to all
+        of its metrics. The last cached data point is retrieved again as it
+        may have been incomplete when it was cached.
+
+        The request is returned unchanged unless the cached data of every
+        metric reaches back to the first data point of the request's time
+        window, for example if the window has been extended or moved
+        earlier since the data was cached."""
+        metrics = self.cached_metrics(request)
+        if not metrics or not all(metric['data'] for metric in metrics):
+            return request
+        stop = parse_timestamp(request['stop'])
+        first_needed = stop - timedelta(seconds=request['step'] *
+                                        (request['limit'] - 1))
+        if any(parse_timestamp(metric['data'][0]['timestamp']) >
+               first_needed for metric in metrics):
+            return request
+        last = min(parse_timestamp(metric['data'][-1]['timestamp'])
+                   for metric in metrics)
+        limit = int((stop - last).total_seconds()) // request['step'] + 1
+        return dict(request, limit=max(1, min(limit, request['limit'])))
+
+    def merge(self, request, series, trimmed=True):
+        """Merge newly retrieved series data for a metric request with the
+        cached data, update the cache and return the data points within the
+        request's time window.
+
+        If the request wasn't trimmed, the whole window was retrieved and
+        replaces the cached data, so that the cached data for each metric
+        always covers a single contiguous period."""
+        stop = parse_timestamp(request['stop'])
+        metrics = join_chunks([(trimmed and self.cached_metrics(request))
+                               or [], series])
+        window_start = stop - timedelta(seconds=request['step'] *
+                                        request['limit'])
+        retention_start = stop - self.retention
+        now = datetime.now(timezone.utc).isoformat()
+
+        for metric_id in request['metric_id'].split(','):
+            self.entries[self.key(request, metric_id)] = {
+                'updated': now,
+                'metrics': [dict(metric, data=[
+                    data_point for data_point in metric['data']
+                    if parse_timestamp(data_point['timestamp']) >
+                    retention_start])
+                            for metric in metrics
+                            if metric['header']['name'] == metric_id]}
+
+        return [dict(metric, data=[
+            data_point for data_point in metric['data']
+            if window_start < parse_timestamp(data_point['timestamp']) <=
+            stop]) for metric in metrics]
+
+    def save(self):
+        expired = (datetime.now(timezone.utc) - self.retention).isoformat()
+        self.entries = {key: entry for key, entry in self.entries.items()
+                        if entry['updated'] > expired}
+        with open(f'{self.filename}.tmp', 'w',
+                  encoding='UTF-8') as cache_file:
+            json.dump(self.entries, cache_file)
+        replace(f'{self.filename}.tmp', self.filename)
+
+
+class NameCache:
+    """A local on-disk cache of the Controller version and of the name to
+    UUID mappings of each object type, kept separately per user,
+    controller and tenant, so that scheduled runs don't need to look these
+    up every time. Entries expire after ttl seconds."""
+
+    def __init__(self, filename, prefix, ttl):
+        self.filename = filename
+        self.prefix = prefix
+        self.ttl = ttl
+        self.entries = {}
+        if exists(filename):
+            with open(filename, 'r', encoding='UTF-8') as cache_file:
+                self.entries = json.load(cache_file)
+
+    def get(self, key):
+        entry = self.entries.get(self.prefix, {}).get(key)
+        if entry and entry['time'] > time.time() - self.ttl:
+            return entry['value']
+        return None
+
+    def set(self, key, value):
+        self.entries.setdefault(self.prefix, {})[key] = {
+            'time': time.time(), 'value': value}
+        with open(f'{self.filename}.tmp', 'w',
+                  encoding='UTF-8') as cache_file:
+            json.dump(self.entries, cache_file)
+        replace(f'{self.filename}.tmp', self.filename)
+
+
+def find_objects(api, tenant, obj_type, names, name_cache=None):
+    """Return a list of (name, uuid) tuples for the objects of obj_type
+    matching a comma-separated list of names and/or glob patterns.
+
+    Without a name cache, a single name is looked up directly, otherwise
+    the names and UUIDs of all objects of the type are listed once and
+    matched against each pattern. With a name cache, the listing is taken
+    from the cache, and is only refreshed if it has expired or if any of
+    the patterns doesn't match a cached name."""
+    patterns = [n for n in names.split(',') if n]
+
+    if (not name_cache and len(patterns) == 1 and
+            not any(c in patterns[0] for c in '*?[')):
+        obj = api.get_object_by_name(obj_type, patterns[0], tenant=tenant)
+        return [(patterns[0], obj['uuid'])] if obj else []
+
+    obj_list = name_cache.get(obj_type) if name_cache else None
+
+    if obj_list is None or not all(
+            any(fnmatch(obj_name, pattern) for obj_name, _ in obj_list)
+            for pattern in patterns):
+        obj_list = [(obj['name'], obj['uuid'])
+                    for obj in api.get_objects_iter(
+                        obj_type, params={'fields': 'name,uuid'},
+                        tenant=tenant)]
+        if name_cache:
+            name_cache.set(obj_type, obj_list)
+
+    return [(obj_name, obj_uuid) for obj_name, obj_uuid in obj_list
+            if any(fnmatch(obj_name, pattern) for pattern in patterns)]
+
+
+def chunk_metric_requests(metric_requests, chunk_points=CHUNK_POINTS):
+    """Split any metric request for more than chunk_points data points
+    into several requests covering consecutive time ranges of at most
+    chunk_points each, working backwards from the request's stop time.
+
+    Returns a list of (id, chunk_requests) tuples, one per original
+    request, with the chunks in ascending time order."""
+    chunked = []
+    for request in metric_requests:
+        limit = request['limit']
+        if limit <= chunk_points:
+            chunked.append((request['id'], [request]))
+            continue
+        stop = datetime.fromisoformat(request['stop'])
+        step = timedelta(seconds=request['step'])
+        chunks = []
+        for n, offset in enumerate(range(0, limit, chunk_points)):
+            chunks.insert(0, dict(
+                request, id=f'{request["id"]}#{n}',
+                stop=datetime.isoformat(stop - offset * step),
+                limit=min(chunk_points, limit - offset)))
+        chunked.append((request['id'], chunks))
+    return chunked
+
+
+def join_chunks(chunk_series):
+    """Join the series returned for each time-range chunk of a metric
+    request into a single series, with the data for each metric sorted by
+    timestamp and any duplicate timestamps at chunk boundaries removed."""
+    joined = {}
+    for series in chunk_series:
+        for metric in series:
+            key = (metric['header']['name'], metric['header'].get('obj_id'))
+            if key not in joined:
+                joined[key] = (metric['header'], {})
+            joined[key][1].update((data_point['timestamp'], data_point)
+                                  for data_point in metric.get('data', []))
+    return [{'header': header, 'data': [data[k] for k in sorted(data)]}
+            for header, data in joined.values()]
+
+
+def align_metrics(metrics):
+    """Align the data points of a list of metrics on their combined set of
+    timestamps.
+
+    Returns a sorted list of timestamps and a matrix of values with a row
+    per timestamp and a column per metric, containing NaN wherever a metric
+    has no data point for a timestamp."""
+    metric_data = [metric.get('data', []) for metric in metrics]
+    timestamps = sorted({data_point['timestamp'] for data in metric_data
+                         for data_point in data})
+    row_index = {timestamp: row for row, timestamp in enumerate(timestamps)}
+    values = np.full((len(timestamps), len(metrics)), np.nan)
+    for column, data in enumerate(metric_data):
+        rows = np.fromiter((row_index[data_point['timestamp']]
+                            for data_point in data),
+                           dtype=np.intp, count=len(data))
+        values[rows, column] = np.array(
+            [data_point['value'] for data_point in data], dtype=float)
+    return timestamps, values
+
+
+def aligned_rows(timestamps, values):
+    """Return aligned timestamps and values as a list of output rows, with
+    missing values left empty."""
+    table = np.empty((len(timestamps), values.shape[1] + 1), dtype=object)
+    table[:, 0] = timestamps
+    table[:, 1:] = values.astype(object)
+    table[:, 1:][np.isnan(values)] = None
+    return table.tolist()
+
+
+def rollup_series(series, rollup, function):
+    """Roll up the data points of each metric in a series into windows of
+    rollup seconds, aligned to the Unix epoch, using function (avg, min,
+    max, sum or pN for the Nth percentile). As with the Controller's own
+    data points, each window is labelled with its end time and covers the
+    data points with timestamps after its start up to and including its
+    end. Missing data points are ignored."""
+    timestamps, values = align_metrics(series)
+    if not timestamps:
+        return series
+
+    epochs = np.array([parse_timestamp(timestamp).timestamp()
+                       for timestamp in timestamps])
+    window_ends, starts = np.unique(-(-epochs // rollup) * rollup,
+                                    return_index=True)
+    present = ~np.isnan(values)
+    counts = np.add.reduceat(present, starts)
+
+    if function in ('avg', 'sum'):
+        rolled = np.add.reduceat(np.where(present, values, 0), starts)
+        if function == 'avg':
+            with np.errstate(invalid='ignore'):
+                rolled = rolled / counts
+    elif function == 'min':
+        rolled = np.fmin.reduceat(values, starts)
+    elif function == 'max':
+        rolled = np.fmax.reduceat(values, starts)
+    else:
+        percentile = float(function[1:])
+        rolled = np.full((len(window_ends), values.shape[1]), np.nan)
+        for window, (start, stop) in enumerate(
+                zip(starts, [*starts[1:], len(timestamps)])):
+            window_values = values[start:stop]
+            columns = present[start:stop].any(axis=0)
+            rolled[window, columns] = np.nanpercentile(
+                window_values[:, columns], percentile, axis=0)
+    rolled[counts == 0] = np.nan
+
+    window_timestamps = [datetime.fromtimestamp(window_end,
+                                                timezone.utc).isoformat()
+                         for window_end in window_ends]
+    return [dict(metric, data=[
+        {'timestamp': timestamp, 'value': float(value)}
+        for timestamp, value in zip(window_timestamps, rolled[:, column])
+        if not np.isnan(value)]) for column, metric in enumerate(series)]
+
+
+def collect_metrics(api, tenant, metric_requests, batch_size=BATCH_SIZE,
+                    workers=WORKERS, chunk_points=CHUNK_POINTS, failed=None):
+    """Retrieve the metrics for a list of metric requests, packing up to
+    batch_size requests into each analytics/metrics/collection call and
+    making up to workers calls concurrently. Requests for more than
+    chunk_points data points are split into time-range chunks which are
+    retrieved separately and joined back together.
+
+    Requests in a batch which couldn't be retrieved are left out of the
+    result, and if a failed list is given their ids are appended to it.
+
+    Returns the combined series dict, keyed by metric request id, in the
+    same order as metric_requests."""
+    chunked = chunk_metric_requests(metric_requests, chunk_points)
+    chunk_requests = [chunk for _, chunks in chunked for chunk in chunks]
+    batches = [chunk_requests[n:n + batch_size]
+               for n in range(0, len(chunk_requests), batch_size)]
+    request_ids = {chunk['id']: request_id for request_id, chunks in chunked
+                   for chunk in chunks}
+    failed_ids = set()
+
+    def collect_batch(batch):
+        rsp = api.post('analytics/metrics/collection',
+                       data={'metric_requests': batch}, tenant=tenant)
+        if rsp.status_code >= 300:
+            print(f'Error retrieving metrics: {rsp.text}')
+            failed_ids.update(request_ids[chunk['id']] for chunk in batch)
+            return {}
+        return rsp.json().get('series', {})
+
+    series_data = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch_series in executor.map(collect_batch, batches):
+            series_data.update(batch_series)
+
+    if failed is not None:
+        failed.extend(request_id for request_id, _ in chunked
+                      if request_id in failed_ids)
+
+    ordered_series = {}
+    for request_id, chunks in chunked:
+        if request_id in failed_ids:
+            # Drop any chunks of the request that were retrieved, as the
+            # request's data would be incomplete
+
+            for chunk in chunks:
+                series_data.pop(chunk['id'], None)
+            continue
+        if len(chunks) == 1:
+            if request_id in series_data:
+                ordered_series[request_id] = series_data.pop(request_id)
+            continue
+        chunk_series = [series_data.pop(chunk['id']) for chunk in chunks
+                        if chunk['id'] in series_data]
+        if chunk_series:
+            ordered_series[request_id] = join_chunks(chunk_series)
+    ordered_series.update(series_data)
+    return ordered_series
+
+
+def group_requests(metric_requests, group_size, fanout=None):
+    """Split a list of metric requests into groups of requests for up to
+    group_size entities, keeping all the fanned-out requests for an
+    entity in the same group."""
+    groups = []
+    for _, entity_requests in groupby(
+            metric_requests,
+            key=lambda request: (fanout[request['id']][0] if fanout
+                                 else request['id'])):
+        if not groups or len(groups[-1]) == group_size:
+            groups.append([])
+        groups[-1].append(list(entity_requests))
+    return [[request for entity_requests in group
+             for request in entity_requests] for group in groups]
+
+
+def time_chunk_groups(metric_requests, chunk_points=CHUNK_POINTS):
+    """Split a list of metric requests into a list of groups of requests,
+    one group per time-range chunk of up to chunk_points data points, in
+    ascending time order. Each chunk request keeps the id of the request
+    it was split from."""
+    groups = {}
+    for request_id, chunks in chunk_metric_requests(metric_requests,
+                                                    chunk_points):
+        for n, chunk in enumerate(reversed(chunks)):
+            groups.setdefault(n, []).append(dict(chunk, id=request_id))
+    return [groups[n] for n in sorted(groups, reverse=True)]
+
+
+class TableWriter:
+    """Writes output tables to a CSV or JSON lines file as they are
+    produced, or displays them on screen if there is no file. The file is
+    only created when the first table is written. An untitled table with
+    the same headers as the previous one continues that table."""
+
+    def __init__(self, filename, output_format='csv'):
+        self.filename = filename
+        self.output_format = output_format
+        self.file = None
+        self.tables = 0
+        self.headers = None
+
+    def write(self, headers, rows, title=None, title_row=True):
+        """Write a table, optionally with a title: in CSV files the title
+        is written on a row of its own before the table if title_row is
+        set, while in JSON lines files it is added to each record as its
+        series."""
+        self.tables += 1
+
+        if not self.filename:
+            if title:
+                print()
+                print(f'Series {title}:')
+            print(tabulate(rows, headers=headers, tablefmt='outline'))
+            return
+
+        if not self.file:
+            self.file = open(self.filename, 'w', newline='',
+                             encoding='UTF-8')
+
+        if self.output_format == 'jsonl':
+            prefix = {'Series': title} if title else {}
+            self.file.writelines(
+                json.dumps({**prefix, **dict(zip(headers, row))}) + '\n'
+                for row in rows)
+        else:
+            csv_writer = csv.writer(self.file, dialect='excel')
+            if title and title_row:
+                csv_writer.writerow([title])
+            if title or headers != self.headers:
+                csv_writer.writerow(headers)
+            csv_writer.writerows(rows)
+
+        self.headers = None if title else headers
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+def fan_out_requests(metric_requests, obj_ids):
+    """Split each metric request into a request per object ID in the list
+    obj_ids.
+
+    Returns the list of new metric requests and a dict mapping each new
+    request's id to the original request's id and the object ID."""
+    fanout = {}
+    obj_requests = []
+    for request in metric_requests:
+        for obj_id in obj_ids:
+            fanout_id = f'{request["id"]}|{obj_id}'
+            fanout[fanout_id] = (request['id'], obj_id)
+            obj_requests.append(dict(request, id=fanout_id, obj_id=obj_id))
+    return obj_requests, fanout
+
+
+def fan_in_series(series_data, fanout):
+    """Combine the series retrieved for fanned-out metric requests back
+    into a single series per original metric request, with the header of
+    each metric identifying its object ID."""
+    combined = {}
+    for series_id, series in series_data.items():
+        request_id, obj_id = fanout.get(series_id, (series_id, None))
+        combined.setdefault(request_id, []).extend(
+            dict(metric, header=dict(metric['header'], obj_id=obj_id))
+            if obj_id else metric for metric in series)
+    return combined
+
+
+def metric_label(header):
+    """Return the column heading for a metric, including its object ID
+    if it has one."""
+    if header.get('obj_id'):
+        return f'{header["name"]} ({header["obj_id"]}) in {header["units"]}'
+    return f'{header["name"]} in {header["units"]}'
+
+
+def openmetrics_name(metric_id):
+    """Convert an Avi metric ID to a valid OpenMetrics metric name."""
+    return 'avi_' + re.sub(r'[^a-zA-Z0-9_]', '_', metric_id)
+
+
+def openmetrics_label(value):
+    """Escape a string for use as an OpenMetrics label value."""
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def openmetrics_text(series_data):
+    """Render the latest data point of each metric in series_data in the
+    OpenMetrics text exposition format, with a sample per series (and
+    object ID, if any) for each metric."""
+    samples = {}
+    for series_name, series in series_data.items():
+        for metric in series:
+            header = metric['header']
+            data = [data_point for data_point in metric.get('data', [])
+                    if data_point.get('value') is not None]
+            if not data:
+                continue
+            labels = f'series="{openmetrics_label(series_name)}"'
+            if header.get('obj_id'):
+                labels += f',obj_id="{openmetrics_label(header["obj_id"])}"'
+            labels += f',units="{openmetrics_label(header["units"])}"'
+            timestamp = parse_timestamp(data[-1]['timestamp']).timestamp()
+            samples.setdefault(openmetrics_name(header['name']), []).append(
+                f'{{{labels}}} {float(data[-1]["value"])} {timestamp:.3f}')
+
+    lines = []
+    for name, metric_samples in samples.items():
+        lines.append(f'# TYPE {name} gauge')
+        lines.extend(f'{name}{sample}' for sample in metric_samples)
+    return lines
+
+
+class MetricsExporter:
+    """Periodically retrieves a set of metric requests using a single
+    long-lived API session and serves the latest values over HTTP in the
+    OpenMetrics text format.
+
+    Each refresh renders a complete snapshot which then replaces the
+    previous one, so scrapes are answered from memory and never result
+    in an API call to the Controller."""
+
+    def __init__(self, api, tenant, metric_requests, interval,
+                 batch_size=BATCH_SIZE, workers=WORKERS, fanout=None):
+        self.api = api
+        self.tenant = tenant
+        self.metric_requests = metric_requests
+        self.fanout = fanout
+        self.interval = interval
+        self.batch_size = batch_size
+        self.workers = workers
+        self.snapshot = b'# EOF\n'
+
+    def refresh(self):
+        start_time = time.time()
+        stop = datetime.now(timezone.utc).isoformat()
+        series_data = collect_metrics(
+            self.api, self.tenant,
+            [dict(request, stop=stop) for request in self.metric_requests],
+            self.batch_size, self.workers)
+        if self.fanout:
+            series_data = fan_in_series(series_data, self.fanout)
+        duration = time.time() - start_time
+        lines = openmetrics_text(series_data)
+        lines.extend([
+            '# TYPE avi_exporter_refresh_duration_seconds gauge',
+            f'avi_exporter_refresh_duration_seconds {duration:.3f}',
+            '# TYPE avi_exporter_last_refresh_timestamp_seconds gauge',
+            f'avi_exporter_last_refresh_timestamp_seconds {start_time:.3f}',
+            '# EOF'])
+        self.snapshot = ('\n'.join(lines) + '\n').encode()
+        return len(series_data), duration
+
+    def refresh_loop(self):
+        while True:
+            next_refresh = time.time() + self.interval
+            try:
+                num_series, duration = self.refresh()
+                print(f'Refreshed {num_series} series in {duration:.1f}s',
+                      flush=True)
+            except Exception as e:
+                print(f'Error refreshing metrics: {e}', flush=True)
+            time.sleep(max(next_refresh - time.time(), 0))
+
+    def serve(self, host, port):
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                snapshot = exporter.snapshot
+                self.send_response(200)
+                self.send_header('Content-Type', OPENMETRICS_CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(snapshot)))
+                self.end_headers()
+                self.wfile.write(snapshot)
+
+            def log_message(self, format, *args):
+                pass
+
+        threading.Thread(target=self.refresh_loop, daemon=True).start()
+        server = ThreadingHTTPServer((host, port), Handler)
+        print(f'Serving metrics on http://{host}:{port}/metrics')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter)
@@ -41,8 +656,7 @@ if __name__ == '__main__':
                         default='l4_client.avg_rx_bytes,l4_client.avg_tx_bytes')
     parser.add_argument('-g', '--granularity',
                         help='Granularity of metrics',
-                        choices=['realtime', '5min', 'hour', 'day'],
-                        default='5min')
+                        choices=['realtime', '5min', 'hour', 'day'])
     parser.add_argument('-e', '--end',
                         help='End date/time for metrics in ISO8601 '
                              'format (default=now)')
@@ -50,23 +664,98 @@ if __name__ == '__main__':
                         help='Timespan of metrics in seconds or append '
                              'm(inutes), h(ours) or d(ays)',
                              default='60m')
-    parser.add_argument('-se', '--serviceengine', help='Service Engine Name')
+    parser.add_argument('-se', '--serviceengine',
+                        help='Service Engine Name(s) - a comma-separated '
+                             'list of names and/or glob patterns')
     parser.add_argument('-vs', '--virtualservice',
-                        help='Virtual Service Name')
+                        help='Virtual Service Name(s) - a comma-separated '
+                             'list of names and/or glob patterns')
     parser.add_argument('-a', '--aggregate',
                         help='Aggregate metrics', action='store_true')
     parser.add_argument('-pl', '--pool',
-                        help='Pool Name')
-    parser.add_argument('-f', '--file', help='Output to named CSV file')
+                        help='Pool Name(s) - a comma-separated list of '
+                             'names and/or glob patterns')
+    parser.add_argument('-f', '--file',
+                        help='Output to named CSV or JSON lines file')
+    parser.add_argument('-of', '--outputformat',
+                        help='Output file format (default=csv, or jsonl if '
+                             'the filename ends in .jsonl)',
+                        choices=['csv', 'jsonl'])
     parser.add_argument('-o', '--objid',
                         help='Optional object ID - required for metrics that '
                              'relate to specific components such as WAF rule '
                              'or WAF group metrics')
     parser.add_argument('-ao', '--aggregateobjid',
                         help='Aggregate object IDs', action='store_true')
+    parser.add_argument('-fo', '--fanout',
+                        help='Retrieve the metrics for each of the object '
+                             'IDs given by -o/--objid separately, as '
+                             'concurrent batched requests (not used with '
+                             '-o *, which already returns each object ID '
+                             'separately)',
+                        action='store_true')
     parser.add_argument('-pd', '--paddata',
                         help='Pad missing data in the output',
                         action='store_true')
+    parser.add_argument('-lo', '--layout',
+                        help='Output layout: a table per series (default), '
+                             'a single wide table with a column per series '
+                             'and metric, a single long table with a row '
+                             'per series, metric and timestamp, or a single '
+                             'table with a row per object ID and timestamp',
+                        choices=['series', 'wide', 'long', 'objid'],
+                        default='series')
+    parser.add_argument('-b', '--batchsize',
+                        help='Maximum number of entities per metrics API '
+                             f'call (default={BATCH_SIZE})',
+                        type=int, default=BATCH_SIZE)
+    parser.add_argument('-w', '--workers',
+                        help='Maximum number of concurrent metrics API '
+                             f'calls (default={WORKERS})',
+                        type=int, default=WORKERS)
+    parser.add_argument('-cp', '--chunkpoints',
+                        help='Maximum number of data points per metric '
+                             'request - longer histories are split into '
+                             'chunks which are retrieved concurrently '
+                             f'(default={CHUNK_POINTS})',
+                        type=int, default=CHUNK_POINTS)
+    parser.add_argument('-ca', '--cache',
+                        help='Cache metrics data in the named file so that '
+                             'subsequent runs only retrieve new data points')
+    parser.add_argument('-cr', '--cacheretention',
+                        help='Timespan of metrics data to keep in the '
+                             'cache in seconds or append m(inutes), '
+                             'h(ours) or d(ays) (default=history)')
+    parser.add_argument('-ex', '--exporter', metavar='[HOST:]PORT',
+                        help='Run as an exporter, serving the latest value '
+                             'of each metric on http://[HOST:]PORT/metrics '
+                             'in OpenMetrics format. HOST defaults to '
+                             f'{EXPORTER_HOST} - use 0.0.0.0 to listen on '
+                             'all interfaces')
+    parser.add_argument('-ri', '--refreshinterval',
+                        help='Interval in seconds between metrics '
+                             'refreshes in exporter mode '
+                             f'(default={EXPORTER_INTERVAL})',
+                        type=int, default=EXPORTER_INTERVAL)
+    parser.add_argument('-nc', '--namecache',
+                        help='Cache the Controller version and object '
+                             'names and UUIDs in the named file')
+    parser.add_argument('-nt', '--namecachettl',
+                        help='Time to keep cached names and UUIDs in '
+                             'seconds or append m(inutes), h(ours) or '
+                             f'd(ays) (default={NAME_CACHE_TTL})',
+                        default=NAME_CACHE_TTL)
+    parser.add_argument('-ru', '--rollup',
+                        help='Roll up metrics into windows of the given '
+                             'timespan in seconds or append m(inutes), '
+                             'h(ours) or d(ays). If no granularity is '
+                             'specified, the coarsest granularity that fits '
+                             'the windows is used')
+    parser.add_argument('-rf', '--rollupfunction',
+                        help='Function used to roll up metrics: avg, min, '
+                             'max, sum or pN for the Nth percentile '
+                             '(default=avg)',
+                        default='avg')
 
     args = parser.parse_args()
 
@@ -89,22 +778,61 @@ if __name__ == '__main__':
         aggregate = args.aggregate
         agg_objid = args.aggregateobjid
         metrics = args.metrics.split(',')
-        granularity = granularity_to_seconds[args.granularity]
+        granularity = args.granularity
         end = datetime.isoformat(datetime.fromisoformat(args.end)
                                  if args.end else datetime.now(timezone.utc))
         history = args.history
         csv_filename = args.file
+        output_format = args.outputformat or (
+            'jsonl' if csv_filename and csv_filename.endswith('.jsonl')
+            else 'csv')
         obj_id = args.objid
         pad_data = args.paddata
+        fan_out = args.fanout
+        layout = args.layout
+        batch_size = max(args.batchsize, 1)
+        workers = max(args.workers, 1)
+        chunk_points = max(args.chunkpoints, 1)
+        cache_filename = args.cache
+        cache_retention = args.cacheretention or args.history
+        exporter = args.exporter
+        refresh_interval = max(args.refreshinterval, 1)
+        name_cache_filename = args.namecache
+        name_cache_ttl = parse_timespan(args.namecachettl)
+        rollup = parse_timespan(args.rollup) if args.rollup else None
+        rollup_function = args.rollupfunction
 
-        if history[-1] == 'm':
-            history = int(history[:-1]) * SECONDS_PER_MINUTE
-        elif history[-1] == 'h':
-            history = int(history[:-1]) * SECONDS_PER_HOUR
-        elif history[-1] == 'd':
-            history = int(history[:-1]) * SECONDS_PER_DAY
-        else:
-            history = int(history)
+        history = parse_timespan(history)
+
+        if fan_out and (not obj_id or agg_objid):
+            print('-fo/--fanout requires -o/--objid and cannot be used with '
+                  '-ao/--aggregateobjid')
+            exit()
+
+        if rollup:
+            if not re.fullmatch(r'avg|min|max|sum|p\d+(\.\d+)?',
+                                rollup_function) or (
+                    rollup_function[0] == 'p' and
+                    float(rollup_function[1:]) > 100):
+                print(f'Invalid rollup function "{rollup_function}"')
+                exit()
+            if not granularity:
+                # Use the coarsest granularity that fits the rollup window
+
+                granularity = max(
+                    (g for g in granularity_to_seconds
+                     if rollup % granularity_to_seconds[g] == 0),
+                    key=granularity_to_seconds.get, default=None)
+                if granularity:
+                    print(f'Using {granularity} granularity for rollups.')
+            elif rollup % granularity_to_seconds[granularity]:
+                granularity = None
+            if not granularity:
+                print('The rollup timespan must be a multiple of the '
+                      'metrics granularity')
+                exit()
+
+        granularity = granularity_to_seconds[granularity or '5min']
 
         limit = history // granularity
 
@@ -114,6 +842,16 @@ if __name__ == '__main__':
         while not password:
             password = getpass.getpass(f'Password for {user}@{controller}:')
 
+        if name_cache_filename:
+            name_cache = NameCache(name_cache_filename,
+                                   f'{user}@{controller}/{tenant}',
+                                   name_cache_ttl)
+        else:
+            name_cache = None
+
+        if not api_version and name_cache:
+            api_version = name_cache.get('version')
+
         if not api_version:
             # Discover Controller's version if no API version specified
 
@@ -121,28 +859,31 @@ if __name__ == '__main__':
             api_version = api.remote_api_version['Version']
             api.delete_session()
             print(f'Discovered Controller version {api_version}.')
+            if name_cache:
+                name_cache.set('version', api_version)
         api = ApiSession.get_session(controller, user, password,
                                      api_version=api_version)
 
         if se:
-            se_obj = api.get_object_by_name('serviceengine', se, tenant=tenant)
+            se_list = find_objects(api, tenant, 'serviceengine', se,
+                                   name_cache)
 
-            if not se_obj:
+            if not se_list:
                 print(f'Unable to locate Service Engine "{se}"')
                 exit()
 
         if pool:
-            pool_obj = api.get_object_by_name('pool', pool, tenant=tenant)
+            pool_list = find_objects(api, tenant, 'pool', pool, name_cache)
 
-            if not pool_obj:
+            if not pool_list:
                 print(f'Unable to locate Pool "{pool}"')
                 exit()
 
         if vs:
-            vs_obj = api.get_object_by_name('virtualservice', vs,
-                                            tenant=tenant)
+            vs_list = find_objects(api, tenant, 'virtualservice', vs,
+                                   name_cache)
 
-            if not vs_obj:
+            if not vs_list:
                 print(f'Unable to locate Virtual Service "{vs}"')
                 exit()
 
@@ -152,77 +893,243 @@ if __name__ == '__main__':
         # vs only - Retrieve Metrics for specified Virtual Service
         # pool only - Retrive Metrics for specified Pool
         # vs + pool - Retrieve Metrics for specified Virtual Service and Pool
+        #
+        # Each of se, vs and pool may match several objects, in which case
+        # a metric request is made for each one (or each combination of
+        # Virtual Service and Pool). Each request's id is used as the name
+        # of its series in the output.
 
         params = {'stop': end, 'step': granularity, 'limit': limit,
                   'metric_id': ','.join(metrics),
                   'pad_missing_data': pad_data}
 
+        if obj_id:
+            params['obj_id'] = obj_id
+            if agg_objid:
+                params['aggregate_obj_id'] = True
+
+        metric_requests = []
+
         if se and not(vs or pool):
-            if aggregate:
-                params['aggregate_entity'] = True
-                params['entity_uuid'] = '*'
-                params['service_engine_uuid'] = se_obj['uuid']
-            else:
-                params['entity_uuid'] = se_obj['uuid']
+            for se_name, se_uuid in se_list:
+                if aggregate:
+                    metric_requests.append(dict(
+                        params, id=se_name, aggregate_entity=True,
+                        entity_uuid='*', service_engine_uuid=se_uuid))
+                else:
+                    metric_requests.append(dict(params, id=se_name,
+                                                entity_uuid=se_uuid))
         elif vs and not(se or pool):
-            params['entity_uuid'] = vs_obj['uuid']
+            for vs_name, vs_uuid in vs_list:
+                metric_requests.append(dict(params, id=vs_name,
+                                            entity_uuid=vs_uuid))
         elif pool and not(vs or se):
-            params['entity_uuid'] = pool_obj['uuid']
+            for pool_name, pool_uuid in pool_list:
+                metric_requests.append(dict(params, id=pool_name,
+                                            entity_uuid=pool_uuid))
         elif not(se) and vs and pool:
-            params['entity_uuid'] = vs_obj['uuid']
-            params['pool_uuid'] = pool_obj['uuid']
+            for (vs_name, vs_uuid), (pool_name, pool_uuid) in product(
+                    vs_list, pool_list):
+                metric_requests.append(dict(params,
+                                            id=f'{vs_name}:{pool_name}',
+                                            entity_uuid=vs_uuid,
+                                            pool_uuid=pool_uuid))
         else:
             print('Unsupported combination of options')
             exit()
 
-        if obj_id:
-            params['obj_id'] = obj_id
-            if agg_objid:
-                params['aggregate_obj_id'] = True
+        num_entities = len(metric_requests)
 
-        data = {'metric_requests': [params]}
+        if num_entities > 1:
+            print(f'Retrieving metrics for {num_entities} entities...')
 
-        metrics = api.post('analytics/metrics/collection',
-                           data=data, tenant=tenant).json()
+        fanout = None
+        failed = []
 
-        series_data = metrics.get('series', {})
+        # A request for all object IDs (*) already returns a separate
+        # series for each object ID with data at any time in its window,
+        # so only lists of object IDs need to be fanned out
 
-        num_series = len(series_data)
+        if fan_out and obj_id != '*':
+            metric_requests, fanout = fan_out_requests(
+                metric_requests, [o for o in obj_id.split(',') if o])
 
-        if num_series == 0:
-            print('No data was returned - did you get a parameter wrong?')
+            print(f'Retrieving metrics for {len(metric_requests)} entity '
+                  'and object ID combinations...')
+
+        if exporter:
+            host, _, port = exporter.rpartition(':')
+            host = host or EXPORTER_HOST
+            MetricsExporter(api, tenant, metric_requests, refresh_interval,
+                            batch_size, workers, fanout).serve(host,
+                                                               int(port))
             exit()
 
-        for index, (series_name, series) in enumerate(series_data.items()):
-            headers = ['Timestamp']
-            output = {}
+        if cache_filename:
+            cache = MetricsCache(cache_filename, f'{controller}/{tenant}',
+                                 max(parse_timespan(cache_retention),
+                                     history))
+            fetch_requests = {request['id']: cache.trim_request(request)
+                              for request in metric_requests}
+            fetch_limit = max(request['limit']
+                              for request in fetch_requests.values())
+            if fetch_limit < limit:
+                print(f'Retrieving up to {fetch_limit} new data points per '
+                      f'metric, the rest from {cache_filename}...')
+        else:
+            fetch_requests = {request['id']: request
+                              for request in metric_requests}
+            fetch_limit = limit
 
-            for metric in series:
-                metric_name = metric['header']['name']
-                metric_unit = metric['header']['units']
-                headers.append(f'{metric_name} in {metric_unit}')
-                data = metric['data']
-                for data_point in data:
-                    timestamp = data_point['timestamp']
-                    if timestamp not in output:
-                        output[timestamp] = []
-                    output[timestamp].append(data_point['value'])
+        if fetch_limit > chunk_points:
+            print(f'Retrieving {fetch_limit} data points per metric in '
+                  f'chunks of up to {chunk_points}...')
 
-            output_table = [[k, *output[k]] for k in sorted(output)]
+        # When writing to a file in the series or long layouts, metrics
+        # are retrieved and written out for a group of entities at a time,
+        # so that only one group's data needs to be held in memory. The
+        # other layouts need all the data to align it into a single table.
+        #
+        # In the long layout, each group is also retrieved and written out
+        # one time chunk at a time, as its rows don't depend on the data
+        # outside the chunk, unless the data is cached or rolled up as
+        # these need each series' whole time range. In the series layout,
+        # each series' table needs its whole time range
 
-            if csv_filename:
-                print(f'Writing to {csv_filename} for series {series_name}')
-                with open(csv_filename, 'a' if index else 'w',
-                          newline='', encoding='UTF-8') as csv_file:
-                    csv_writer = csv.writer(csv_file, dialect='excel')
-                    if num_series > 1:
-                        csv_writer.writerow([series_name])
-                    csv_writer.writerow(headers)
-                    csv_writer.writerows(output_table)
+        if csv_filename and layout in ('series', 'long'):
+            request_groups = group_requests(metric_requests,
+                                            batch_size * workers, fanout)
+        else:
+            request_groups = [metric_requests]
+
+        if csv_filename and layout == 'long' and not (cache_filename or
+                                                      rollup):
+            fetch_groups = ((request_group, chunk_group)
+                            for request_group in request_groups
+                            for chunk_group in time_chunk_groups(
+                                request_group, chunk_points))
+        else:
+            fetch_groups = ((request_group, [fetch_requests[request['id']]
+                                             for request in request_group])
+                            for request_group in request_groups)
+
+        writer = TableWriter(csv_filename, output_format)
+
+        for request_group, fetch_group in fetch_groups:
+            series_data = collect_metrics(api, tenant, fetch_group,
+                                          batch_size, workers, chunk_points,
+                                          failed)
+
+            if cache_filename:
+                fetched_data = series_data
+                series_data = {}
+                for request in request_group:
+                    if request['id'] in failed:
+                        continue
+                    series = cache.merge(
+                        request, fetched_data.get(request['id'], []),
+                        fetch_requests[request['id']] is not request)
+                    if series:
+                        series_data[request['id']] = series
+
+            if fanout:
+                series_data = fan_in_series(series_data, fanout)
+
+            if rollup:
+                series_data = {series_name: rollup_series(series, rollup,
+                                                          rollup_function)
+                               for series_name, series in series_data.items()}
+
+            if not series_data:
+                continue
+
+            if layout == 'series':
+                for series_name, series in series_data.items():
+                    headers = ['Timestamp']
+
+                    for metric in series:
+                        headers.append(metric_label(metric['header']))
+
+                    output_table = aligned_rows(*align_metrics(series))
+
+                    if csv_filename:
+                        print(f'Writing to {csv_filename} for series '
+                              f'{series_name}')
+                    writer.write(headers, output_table, series_name,
+                                 num_entities > 1)
+                continue
+
+            if layout == 'wide':
+                headers = ['Timestamp']
+                metrics = []
+
+                for series_name, series in series_data.items():
+                    for metric in series:
+                        headers.append(f'{series_name} '
+                                       f'{metric_label(metric["header"])}')
+                        metrics.append(metric)
+
+                output_table = aligned_rows(*align_metrics(metrics))
+            elif layout == 'objid':
+                # A column for each series and metric, and for each object
+                # ID a block of rows with the metrics for that object ID
+
+                headers = ['Object ID', 'Timestamp']
+                columns = {}
+                obj_metrics = {}
+
+                for series_name, series in series_data.items():
+                    for metric in series:
+                        header = metric['header']
+                        key = (series_name, header['name'], header['units'])
+                        if key not in columns:
+                            columns[key] = len(columns)
+                            headers.append(f'{series_name} {header["name"]} '
+                                           f'in {header["units"]}')
+                        obj_metrics.setdefault(header.get('obj_id', ''),
+                                               {})[columns[key]] = metric
+
+                output_table = []
+                for obj, metrics in obj_metrics.items():
+                    timestamps, values = align_metrics(
+                        [metrics.get(column, {}) for column in
+                         range(len(columns))])
+                    output_table.extend([obj, *row] for row in
+                                        aligned_rows(timestamps, values))
             else:
-                print()
-                print(f'Series {series_name}:')
-                print(tabulate(output_table, headers=headers,
-                            tablefmt='outline'))
+                headers = ['Timestamp', 'Series', 'Metric', 'Units', 'Value']
+                if obj_id:
+                    headers.insert(3, 'Object ID')
+                output_table = sorted(
+                    ([data_point['timestamp'], series_name,
+                      metric['header']['name'],
+                      *([metric['header'].get('obj_id', '')]
+                        if obj_id else []),
+                      metric['header']['units'], data_point['value']]
+                     for series_name, series in series_data.items()
+                     for metric in series
+                     for data_point in metric['data']),
+                    key=lambda row: row[0])
+
+            if csv_filename:
+                print(f'Writing {len(series_data)} series to {csv_filename}')
+            writer.write(headers, output_table)
+
+        if cache_filename:
+            cache.save()
+
+        writer.close()
+
+        # Rather than leave an output file which looks complete, fail the
+        # run if any metrics couldn't be retrieved
+
+        if failed:
+            print('Metrics could not be retrieved for the following, which '
+                  'are missing from the output: '
+                  f'{", ".join(dict.fromkeys(failed))}')
+            exit(1)
+
+        if not writer.tables:
+            print('No data was returned - did you get a parameter wrong?')
     else:
         parser.print_help()
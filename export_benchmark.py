@@ -0,0 +1,516 @@
+#!/usr/bin/env python
+
+"""Script to benchmark the export scripts (csv_metrics.py and logs_to_csv.py)
+against a local mock Controller serving synthetic metrics and logs."""
+
+import argparse
+import csv
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import remove
+from os.path import abspath, dirname, join
+from urllib.parse import parse_qs, urlparse
+
+from tabulate import tabulate
+
+from logs_to_csv import FORMULA_PREFIXES, make_row_projector
+
+MOCK_VERSION = '22.1.3'
+LOG_START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+LOG_WINDOW = timedelta(days=1)
+LOG_FIELDS = ['report_timestamp', 'log_id', 'virtualservice',
+              'service_engine', 'client_ip', 'client_src_port',
+              'server_ip', 'server_port', 'method', 'uri_path',
+              'uri_query', 'host', 'response_code', 'request_length',
+              'response_length', 'total_time', 'user_agent', 'referer',
+              'significant', 'significance']
+WAF_RULES = 10
+
+# Shape of the synthetic log entries used by the row projection
+# micro-benchmark
+
+PROJECTOR_ROWS = 20000
+PROJECTOR_FIELDS = 120
+PROJECTOR_PRESENT = 40
+PROJECTOR_VALUES = [1, -1, 1.5, -0.0, True, 'GET', '/index.html', ' =x',
+                    '+1', 'Mozilla/5.0 (X11; Linux)', {'a': 1}, ['x']]
+
+SCRIPT_DIR = dirname(abspath(__file__))
+
+# Each script is run through this wrapper, which writes the script's peak
+# RSS in kB to the file named by its first argument when it exits. On
+# Linux, ru_maxrss is carried across fork and exec, so the peak RSS
+# reported by wait4() for a child process is at least the benchmark's
+# own RSS, whereas VmHWM only covers the process since it was exec'd
+
+PEAK_RSS_WRAPPER = '''
+import atexit, resource, runpy, sys
+from os.path import dirname, exists
+
+def report_peak_rss(filename):
+    if exists('/proc/self/status'):
+        with open('/proc/self/status', encoding='UTF-8') as status:
+            peak_rss = next(line.split()[1] for line in status
+                            if line.startswith('VmHWM:'))
+    else:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with open(filename, 'w', encoding='UTF-8') as rss_file:
+        rss_file.write(str(peak_rss))
+
+atexit.register(report_peak_rss, sys.argv[1])
+sys.argv = sys.argv[2:]
+sys.path[0] = dirname(sys.argv[0])
+runpy.run_path(sys.argv[0], run_name='__main__')
+'''
+
+# Each scenario is (script, mode, arguments). The arguments may contain
+# {vs}, {history}, {rules}, {start}, {end} and {out} placeholders which
+# are filled in for each run
+
+SCENARIOS = [
+    ('csv_metrics.py', 'series',
+     ['-vs', 'bench-vs-*', '-g', 'realtime', '-l', '{history}',
+      '-f', '{out}.csv']),
+    ('csv_metrics.py', 'wide',
+     ['-vs', 'bench-vs-*', '-g', 'realtime', '-l', '{history}',
+      '-lo', 'wide', '-f', '{out}.csv']),
+    ('csv_metrics.py', 'long jsonl',
+     ['-vs', 'bench-vs-*', '-g', 'realtime', '-l', '{history}',
+      '-lo', 'long', '-f', '{out}.jsonl']),
+    ('csv_metrics.py', 'objid fan-out',
+     ['-vs', 'bench-vs-*', '-g', 'realtime', '-l', '{history}',
+      '-o', '{rules}', '-fo', '-lo', 'objid', '-f', '{out}.csv']),
+    ('logs_to_csv.py', 'serial',
+     ['-f', '{out}.csv', '{vs}', '{start}', '{end}']),
+    ('logs_to_csv.py', '4 workers',
+     ['-w', '4', '-f', '{out}.csv', '{vs}', '{start}', '{end}']),
+    ('logs_to_csv.py', 'gzip',
+     ['-f', '{out}.csv.gz', '{vs}', '{start}', '{end}']),
+    ('logs_to_csv.py', 'parquet',
+     ['-f', '{out}.parquet', '{vs}', '{start}', '{end}']),
+]
+
+
+class MockController(ThreadingHTTPServer):
+    """A minimal stand-in for an Avi Controller, implementing just enough
+    of the API for the export scripts: login and version discovery, paged
+    object listings, analytics/metrics/collection and analytics/logs
+    (including indexing progress and paging).
+
+    Metrics and logs are generated on demand from their timestamps, so
+    the amount of data served doesn't affect the mock's memory use. Each
+    response can be delayed by a fixed latency, and the number of requests
+    and data rows served are counted."""
+
+    daemon_threads = True
+
+    def __init__(self, vs_count, metric_count, log_count, latency=0.0,
+                 index_time=0.0):
+        super().__init__(('127.0.0.1', 0), MockHandler)
+        self.objects = {
+            'virtualservice': [
+                {'name': f'bench-vs-{n}', 'uuid': f'virtualservice-{n}'}
+                for n in range(vs_count)],
+            'pool': [{'name': f'bench-pool-{n}', 'uuid': f'pool-{n}'}
+                     for n in range(vs_count)],
+            'serviceengine': [{'name': f'bench-se-{n}',
+                               'uuid': f'serviceengine-{n}'}
+                              for n in range(2)]}
+        self.metric_count = metric_count
+        self.log_count = log_count
+        self.latency = latency
+        self.index_time = index_time
+        self.index_started = {}
+        self._lock = threading.Lock()
+        self.reset()
+
+        # A log entry is rendered by filling its timestamp, ID and
+        # varying fields into a pre-encoded template
+
+        template = {field: f'@{field}@' for field in LOG_FIELDS}
+        template.update(virtualservice='virtualservice-0',
+                        service_engine='serviceengine-0', method='GET',
+                        host='www.example.com', uri_query='',
+                        user_agent='Mozilla/5.0 (benchmark)', referer='',
+                        significant=0, significance='')
+        template = json.dumps(template)
+        for field in ('log_id', 'client_src_port', 'server_port',
+                      'response_code', 'request_length',
+                      'response_length', 'total_time'):
+            template = template.replace(f'"@{field}@"', f'@{field}@')
+        for field in LOG_FIELDS:
+            template = template.replace(f'@{field}@', f'%({field})s')
+        self.log_template = template
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.rows = 0
+            self.bytes = 0
+            self.index_started = {}
+
+    def count(self, rows, size):
+        with self._lock:
+            self.requests += 1
+            self.rows += rows
+            self.bytes += size
+
+    def log_index(self, timestamp):
+        """Return the index of the first log at or after timestamp. Logs
+        have millisecond timestamps, spread evenly over LOG_WINDOW."""
+        window = LOG_WINDOW // timedelta(milliseconds=1)
+        offset = -(-((timestamp - LOG_START) //
+                     timedelta(microseconds=1)) // 1000)
+        return min(max(-(-offset * self.log_count // window), 0),
+                   self.log_count)
+
+    def log_entry(self, n):
+        timestamp = LOG_START + timedelta(milliseconds=(
+            n * (LOG_WINDOW // timedelta(milliseconds=1)) // self.log_count))
+        return self.log_template % {
+            'report_timestamp': timestamp.isoformat(timespec='milliseconds'),
+            'log_id': n, 'client_ip': f'10.{n // 65536 % 256}.'
+                                      f'{n // 256 % 256}.{n % 256}',
+            'client_src_port': 1024 + n % 64000,
+            'server_ip': f'192.168.0.{n % 16}', 'server_port': 80,
+            'uri_path': f'/benchmark/{n % 1000}/index.html',
+            'response_code': 200 if n % 50 else 404,
+            'request_length': 300 + n % 200,
+            'response_length': 2000 + n % 20000, 'total_time': n % 250}
+
+    def logs(self, params):
+        if params.get('download') == 'True':
+            return 0, ','.join(LOG_FIELDS) + '\n', 'text/csv'
+
+        start = datetime.fromisoformat(params['start'])
+        end = datetime.fromisoformat(params['end'])
+        page_size = int(params.get('page_size', 20))
+
+        # Logs for a time range are reported as being indexed until
+        # index_time seconds after the range was first requested
+
+        percent_remaining = 0.0
+        if self.index_time:
+            with self._lock:
+                started = self.index_started.setdefault(
+                    (params['start'], params['end']), time.monotonic())
+            percent_remaining = round(max(0.0, 100.0 * (
+                1 - (time.monotonic() - started) / self.index_time)), 1)
+
+        # Logs are returned newest first from the range [start, end)
+
+        first, last = self.log_index(start), self.log_index(end)
+        indices = range(last - 1, max(first, last - page_size) - 1, -1)
+        body = (f'{{"count": {last - first}, "percent_remaining": '
+                f'{percent_remaining}, "results": [' +
+                ', '.join(self.log_entry(n) for n in indices) + ']}')
+        return len(indices), body, 'application/json'
+
+    def metrics(self, metric_requests):
+        series = {}
+        rows = 0
+        for request in metric_requests:
+            stop = datetime.fromisoformat(request['stop'])
+            if not stop.tzinfo:
+                stop = stop.replace(tzinfo=timezone.utc)
+            step = int(request['step'])
+            last = int(stop.timestamp()) // step * step
+            epochs = range(last - step * (request['limit'] - 1), last + 1,
+                           step)
+            timestamps = [datetime.fromtimestamp(t, timezone.utc).isoformat()
+                          for t in epochs]
+            obj_id = request.get('obj_id')
+            if not obj_id or request.get('aggregate_obj_id'):
+                obj_ids = [None]
+            elif obj_id == '*':
+                obj_ids = [f'rule-{n}' for n in range(WAF_RULES)]
+            else:
+                obj_ids = obj_id.split(',')
+            entity = request.get('entity_uuid', '')
+            metrics = []
+            for metric_id in request['metric_id'].split(','):
+                for obj in obj_ids:
+                    header = {'name': metric_id, 'units': 'METRIC_COUNT',
+                              'entity_uuid': entity}
+                    if obj:
+                        header['obj_id'] = obj
+                    # Each value is derived from its timestamp, so that the
+                    # same data point has the same value whichever request
+                    # it is returned by
+
+                    seed = len(metric_id) + len(entity) + len(obj or '')
+                    metrics.append({'header': header, 'data': [
+                        {'timestamp': timestamp,
+                         'value': float((seed + t // 5 * 7) % 1000)}
+                        for t, timestamp in zip(epochs, timestamps)]})
+                    rows += len(timestamps)
+            series[request.get('id', entity)] = metrics
+        return rows, json.dumps({'series': series}), 'application/json'
+
+    def objects_page(self, obj_type, params):
+        objects = self.objects.get(obj_type, [])
+        if 'name' in params:
+            objects = [obj for obj in objects if obj['name'] == params['name']]
+        page_size = int(params.get('page_size', 25))
+        page = int(params.get('page', 1))
+        results = objects[(page - 1) * page_size:page * page_size]
+        rsp = {'count': len(objects), 'results': results}
+        if page * page_size < len(objects):
+            rsp['next'] = f'/api/{obj_type}?page={page + 1}'
+        return len(results), json.dumps(rsp), 'application/json'
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def respond(self, rows, body, content_type, headers=None):
+        body = body.encode()
+        self.server.count(rows, len(body))
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in (headers or []):
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        path = url.path.removeprefix('/api/')
+        if path == 'analytics/logs':
+            self.respond(*self.server.logs(params))
+        elif path in self.server.objects:
+            self.respond(*self.server.objects_page(path, params))
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        path = urlparse(self.path).path
+        if path == '/login':
+            self.respond(0, json.dumps({'version': {'Version': MOCK_VERSION}}),
+                         'application/json',
+                         [('Set-Cookie', 'csrftoken=benchmark; Path=/'),
+                          ('Set-Cookie', 'sessionid=benchmark; Path=/')])
+        elif path == '/api/analytics/metrics/collection':
+            self.respond(*self.server.metrics(
+                json.loads(body)['metric_requests']))
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def synthetic_log_entries(field_names, count=PROJECTOR_ROWS,
+                          present=PROJECTOR_PRESENT):
+    """Return a reproducible list of sparse log entries, each holding a
+    random selection of present of the field_names with values of mixed
+    types, some of which need escaping as spreadsheet formulae."""
+    rng = random.Random(1)
+    return [{field: rng.choice(PROJECTOR_VALUES)
+             for field in rng.sample(field_names, present)}
+            for _ in range(count)]
+
+
+def legacy_row_projector(field_names):
+    """Return the row projection used by logs_to_csv.py before
+    make_row_projector(), which looks up every known field name in each
+    log entry and converts each value to a string to check for formulae."""
+    def project(res):
+        return ["'" + str(v) if v is not None and
+                str(v).lstrip().startswith(FORMULA_PREFIXES)
+                else v for v in [res.get(f, None) for f in field_names]]
+    return project
+
+
+def benchmark_row_projectors(repeat=3):
+    """Time the legacy and current logs_to_csv.py row projections over the
+    same synthetic log entries and return a table row for each with the
+    best time and the rows projected per second."""
+    field_names = [f'field_{n}' for n in range(PROJECTOR_FIELDS)]
+    entries = synthetic_log_entries(field_names)
+    projectors = [('before (res.get per field)',
+                   legacy_row_projector(field_names)),
+                  ('after (make_row_projector)',
+                   make_row_projector(field_names))]
+
+    # Both projections must produce the same CSV cells
+
+    def cells(row):
+        return [None if v is None else str(v) for v in row]
+    if any(cells(projectors[0][1](res)) != cells(projectors[1][1](res))
+           for res in entries):
+        print('Row projections differ!')
+
+    results = []
+    for name, project in projectors:
+        best = None
+        for _ in range(max(repeat, 1)):
+            start_time = time.perf_counter()
+            for res in entries:
+                project(res)
+            elapsed = time.perf_counter() - start_time
+            best = min(best or elapsed, elapsed)
+        results.append([name, len(entries), round(best, 3),
+                        round(len(entries) / best)])
+    return results
+
+
+def run_scenario(controller, script, args, placeholders, out_dir):
+    """Run an export script against the mock Controller, discarding its
+    output, and return its wall time in seconds and peak RSS in MB."""
+    rss_filename = join(out_dir, 'peak_rss')
+    cmd = [sys.executable, join(SCRIPT_DIR, script), '-c', controller,
+           '-u', 'admin', '-p', 'benchmark',
+           *[arg.format(**placeholders) for arg in args]]
+    start_time = time.perf_counter()
+    with open(os.devnull, 'w', encoding='UTF-8') as output:
+        returncode = subprocess.call(
+            [sys.executable, '-c', PEAK_RSS_WRAPPER, rss_filename, *cmd[1:]],
+            stdout=output, stderr=output, cwd=out_dir)
+    wall_time = time.perf_counter() - start_time
+    if returncode:
+        print(f'  {script} exited with status {returncode} : '
+              f'{" ".join(cmd)}')
+    with open(rss_filename, 'r', encoding='UTF-8') as rss_file:
+        peak_rss = int(rss_file.read())
+    remove(rss_filename)
+    return wall_time, peak_rss / 1024
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='Available scenarios:\n' + '\n'.join(
+            f'  {script} {mode}' for script, mode, _ in SCENARIOS))
+    parser.add_argument('-s', '--scenarios',
+                        help='Comma-separated list of scripts and/or '
+                             'scenarios to run, e.g. "logs_to_csv.py" or '
+                             '"csv_metrics.py wide" (default=all)')
+    parser.add_argument('-n', '--virtualservices',
+                        help='Number of Virtual Services (default=10)',
+                        type=int, default=10)
+    parser.add_argument('-m', '--metrics',
+                        help='Number of metrics per Virtual Service '
+                             '(default=4)',
+                        type=int, default=4)
+    parser.add_argument('-l', '--history',
+                        help='Timespan of metrics in seconds or append '
+                             'm(inutes), h(ours) or d(ays) (default=6h)',
+                        default='6h')
+    parser.add_argument('-lc', '--logcount',
+                        help='Number of logs in the logs time range '
+                             '(default=200000)',
+                        type=int, default=200000)
+    parser.add_argument('-la', '--latency',
+                        help='Latency added to each API response in '
+                             'milliseconds (default=0)',
+                        type=float, default=0.0)
+    parser.add_argument('-it', '--indextime',
+                        help='Time in seconds for which logs are reported as '
+                             'being indexed (default=0)',
+                        type=float, default=0.0)
+    parser.add_argument('-r', '--repeat',
+                        help='Number of times to run each scenario, keeping '
+                             'the fastest run (default=1)',
+                        type=int, default=1)
+    parser.add_argument('-f', '--file', help='Output results to named CSV '
+                                             'file')
+    parser.add_argument('-rp', '--rowprojector',
+                        help='Instead of the scenarios, run a micro-benchmark '
+                             'of the logs_to_csv.py row projection on '
+                             f'{PROJECTOR_ROWS:,} synthetic log entries, '
+                             'before and after make_row_projector(), '
+                             'keeping the best of at least 3 runs',
+                        action='store_true')
+
+    args = parser.parse_args()
+
+    if args and args.rowprojector:
+        print(tabulate(benchmark_row_projectors(max(args.repeat, 3)),
+                       headers=['Projector', 'Rows', 'Best time (s)',
+                                'Rows/s'], tablefmt='outline'))
+    elif args:
+        selected = [s.strip() for s in (args.scenarios or '').split(',')
+                    if s.strip()]
+        scenarios = [(script, mode, scenario_args)
+                     for script, mode, scenario_args in SCENARIOS
+                     if not selected or script in selected or
+                     f'{script} {mode}' in selected]
+
+        if not scenarios:
+            print('No matching scenarios')
+            exit()
+
+        metric_ids = ','.join(f'l4_client.benchmark_{n}'
+                              for n in range(max(args.metrics, 1)))
+        scenarios = [(script, mode, scenario_args + ['-m', metric_ids]
+                      if script == 'csv_metrics.py' else scenario_args)
+                     for script, mode, scenario_args in scenarios]
+
+        server = MockController(max(args.virtualservices, 1),
+                                max(args.metrics, 1), args.logcount,
+                                args.latency / 1000, args.indextime)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        controller = f'http://127.0.0.1:{server.port}'
+        print(f'Mock Controller listening on {controller}')
+
+        placeholders = {'vs': 'bench-vs-0', 'history': args.history,
+                        'rules': ','.join(f'rule-{n}'
+                                          for n in range(WAF_RULES)),
+                        'start': LOG_START.isoformat(),
+                        'end': (LOG_START + LOG_WINDOW).isoformat()}
+
+        headers = ['Script', 'Mode', 'Wall time (s)', 'Requests',
+                   'Requests/s', 'Rows', 'Rows/s', 'MB received',
+                   'Peak RSS (MB)']
+        output_table = []
+
+        with tempfile.TemporaryDirectory() as out_dir:
+            for n, (script, mode, scenario_args) in enumerate(scenarios):
+                print(f'Running {script} {mode}...')
+                best = None
+                for _ in range(max(args.repeat, 1)):
+                    server.reset()
+                    wall_time, peak_rss = run_scenario(
+                        controller, script, scenario_args,
+                        dict(placeholders, out=f'bench{n}'), out_dir)
+                    if not best or wall_time < best[0]:
+                        best = (wall_time, peak_rss, server.requests,
+                                server.rows, server.bytes)
+                wall_time, peak_rss, requests, rows, size = best
+                output_table.append([
+                    script, mode, round(wall_time, 2), requests,
+                    round(requests / wall_time, 1), rows,
+                    round(rows / wall_time), round(size / 1048576, 1),
+                    round(peak_rss, 1)])
+
+        server.shutdown()
+
+        if args.file:
+            with open(args.file, 'w', newline='',
+                      encoding='UTF-8') as csv_file:
+                csv_writer = csv.writer(csv_file, dialect='excel')
+                csv_writer.writerow(headers)
+                csv_writer.writerows(output_table)
+            print(f'Results written to {args.file}')
+
+        print(tabulate(output_table, headers=headers, tablefmt='outline'))
+    else:
+        parser.print_help()
@@ -5,12 +5,23 @@
 import argparse
 import csv
 import getpass
+import hashlib
+import json
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from os import replace
+from os.path import exists
 
 import requests
 import urllib3
 from avi.sdk.avi_api import ApiSession
 from tabulate import tabulate
 
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
 # Disable certificate warnings
 
 if hasattr(requests.packages.urllib3, 'disable_warnings'):
@@ -19,6 +30,378 @@ if hasattr(requests.packages.urllib3, 'disable_warnings'):
 if hasattr(urllib3, 'disable_warnings'):
     urllib3.disable_warnings()
 
+INVENTORY_PAGE_SIZE = 200
+CONCURRENCY = 8
+
+
+def prefetch(func, items, concurrency=CONCURRENCY):
+    """Yield (item, func(item)) for each item in items, in order, while
+    calling func for up to concurrency of the following items in
+    background threads. Items are consumed lazily, so only a bounded
+    number of results are held at any time."""
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = deque()
+        for item in items:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) > concurrency:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+
+def vs_service_engines(vs_runtime):
+    """Return the set of names of the Service Engines on which a Virtual
+    Service is placed, from its inventory runtime data."""
+    vs_selist = set()
+    if 'vip_summary' in vs_runtime:
+        for v in vs_runtime['vip_summary']:
+            if 'service_engine' in v:
+                vs_selist.update(s['url'].split('#')[1]
+                                 for s in v['service_engine'])
+    return vs_selist
+
+
+VS_HEADERS = ['Name', 'UUID', 'Tenant', 'Cloud', 'VRF', 'Type', 'SEG', 'VIPs',
+              'FQDNs', 'Ports', 'Pools', 'Pool Groups', 'App Type', 'WAF',
+              'State', 'Oper State', 'Health Score', 'Service Engines']
+POOL_HEADERS = ['Name', 'UUID', 'Tenant', 'Cloud', 'VRF', 'Port', '#Servers',
+                'State', 'Health Score', 'Virtual Services']
+POOLDETAIL_HEADERS = POOL_HEADERS + ['Servers', 'Service Engines']
+SE_HEADERS = ['Name', 'UUID', 'Tenant', 'Cloud', 'SEG', 'State', 'Oper State',
+              'Connectivity', 'Version', 'Online Since', 'Health Score',
+              'Virtual Services']
+INVENTORY_HEADERS = {'vs': VS_HEADERS, 'pool': POOL_HEADERS,
+                     'pooldetail': POOLDETAIL_HEADERS, 'se': SE_HEADERS}
+
+# Inventories retrieved from the Controller for each inventory type
+
+INVENTORY_SOURCES = {
+    'vs': ['virtualservice-inventory'],
+    'pool': ['pool-inventory'],
+    'pooldetail': ['pool-inventory', 'virtualservice-inventory'],
+    'se': ['serviceengine-inventory']}
+
+
+def get_inventory(api, tenant, obj_type, modified_since=None):
+    """Return an iterator over every object in the named inventory, or
+    only those modified after a given last-modified time."""
+    params = {'include_name': True, 'page_size': INVENTORY_PAGE_SIZE}
+    if modified_since:
+        params['_last_modified.gt'] = modified_since
+    return api.get_objects_iter(obj_type, params=params, tenant=tenant)
+
+
+def vs_service_engine_index(vs_inventory):
+    """Return a dict mapping the UUID of each Virtual Service in the VS
+    inventory to the set of Service Engines on which it is placed."""
+    return {vs['config']['uuid']: vs_service_engines(vs.get('runtime', {}))
+            for vs in vs_inventory}
+
+
+def vs_inventory_rows(vs_inventory):
+    """Yield an output row for each Virtual Service in the VS inventory."""
+    for vs in vs_inventory:
+        vs_config = vs['config']
+        vs_runtime = vs['runtime']
+        vs_name = vs_config['name']
+        vs_uuid = vs_config['uuid']
+        vs_type = vs_config['type'].split('VS_TYPE_')[1]
+        vs_seg = vs_config['se_group_ref'].split('#')[1]
+        vs_tenant = vs_config['tenant_ref'].split('#')[1]
+        vs_cloud = vs_config['cloud_ref'].split('#')[1]
+        vs_vrf = vs_config['vrf_context_ref'].split('#')[1]
+        vs_ports = [(s['port'], s['port_range_end'], s['enable_ssl'])
+                    for s in vs_config['services']]
+        vs_ports = ','.join([f'{a}' + ('' if a == b else f'-{b}') +
+                             ('*' if c else '')
+                             for (a, b, c) in vs_ports])
+        vs_waf = vs_config.get('waf_policy_ref', '#').split('#')[1]
+        vs_app_profile_type = vs.get('app_profile_type',
+                                     'APPLICATION_PROFILE_TYPE_UNKNOWN')
+        vs_app_type = vs_app_profile_type.split(
+            'APPLICATION_PROFILE_TYPE_')[1]
+        all_ip_addresses = []
+        if vs_config['type'] == 'VS_TYPE_VH_CHILD':
+            for v in vs.get('parent_vs_vip', []):
+                all_ip_addresses.extend([v[ip_type]['addr']
+                            for ip_type in ('ip_address', 'ip6_address')
+                            if ip_type in v])
+            vs_fqdns = ','.join(vs_config.get('vh_domain_name', []))
+        else:
+            for v in vs_config.get('vip', []):
+                all_ip_addresses.extend([v[ip_type]['addr']
+                            for ip_type in ('ip_address', 'ip6_address')
+                            if ip_type in v])
+            vs_fqdns = ','.join([d['fqdn']
+                                for d in vs_config.get('dns_info', [])])
+        vs_vips = ','.join(all_ip_addresses)
+        vs_selist = ','.join(sorted(vs_service_engines(vs_runtime)))
+        vs_enabled = 'Enabled' if vs_config['enabled'] else 'Disabled'
+        vs_state = vs_runtime['oper_status']['state'].split('OPER_')[1]
+        vs_hs = vs['health_score']['health_score']
+        vs_pools = ','.join([p.split('#')[1] for p in vs['pools']])
+        vs_poolgroups = ','.join([pg.split('#')[1]
+                                 for pg in vs['poolgroups']])
+        yield [vs_name, vs_uuid, vs_tenant, vs_cloud, vs_vrf, vs_type,
+               vs_seg, vs_vips, vs_fqdns, vs_ports, vs_pools, vs_poolgroups,
+               vs_app_type, vs_waf, vs_enabled, vs_state, vs_hs, vs_selist]
+
+
+def pool_inventory_rows(api, tenant, p_inventory, vs_se_index=None,
+                        concurrency=CONCURRENCY):
+    """Yield an output row for each pool in the pool inventory. If an index
+    of Virtual Service placement (from vs_service_engine_index) is given,
+    the rows also include the details of the pool's servers and of the
+    Service Engines on which the pool's Virtual Services are placed."""
+    detail = vs_se_index is not None
+
+    if detail:
+        # Retrieve the servers of the following pools concurrently while
+        # each pool is being processed
+
+        p_inventory = prefetch(
+            lambda p: list(api.get_objects_iter(
+                f'pool-inventory/{p["config"]["uuid"]}/server',
+                params={'include_name': True},
+                tenant=tenant)), p_inventory, concurrency)
+    else:
+        p_inventory = ((p, None) for p in p_inventory)
+
+    for p, ps_inventory in p_inventory:
+        p_config = p['config']
+        p_runtime = p['runtime']
+        p_name = p_config['name']
+        p_uuid = p_config['uuid']
+        p_tenant = p_config['tenant_ref'].split('#')[1]
+        p_cloud = p_config['cloud_ref'].split('#')[1]
+        p_vrf = p_config['vrf_ref'].split('#')[1]
+        p_port = p_config['default_server_port']
+        p_servers = p_config['num_servers']
+        p_state = p_runtime['oper_status']['state'].split('OPER_')[1]
+        p_hs = p['health_score']['health_score']
+        p_vs = ','.join([vs.split('#')[1]
+                         for vs in p.get('virtualservices', [])])
+
+        output = [p_name, p_uuid, p_tenant, p_cloud, p_vrf, p_port,
+                  p_servers, p_state, p_hs, p_vs]
+
+        if detail:
+            p_servers = [(ps['config']['ip']['addr'],
+                          ps['config']['port'],
+                          ps['runtime']['oper_status']['state'].split(
+                'OPER_')[1],
+                ps['health_score']['health_score'])
+                for ps in ps_inventory]
+
+            output.append(','.join([f'{a}' +
+                                    (f':{b}' if b != p_port else '') +
+                                    f' [{c},{d}]'
+                                    for (a, b, c, d) in p_servers]))
+
+            vs_selist = set()
+            for vs in p.get('virtualservices', []):
+                vs_uuid = vs.split('/api/virtualservice/')[1].split('#')[0]
+                vs_selist.update(vs_se_index.get(vs_uuid, ()))
+            output.append(','.join(sorted(vs_selist)))
+
+        yield output
+
+
+def se_inventory_rows(s_inventory):
+    """Yield an output row for each Service Engine in the SE inventory."""
+    for s in s_inventory:
+        s_config = s['config']
+        s_runtime = s['runtime']
+        s_name = s_config['name']
+        s_uuid = s_config['uuid']
+        s_tenant = s_config['tenant_ref'].split('#')[1]
+        s_cloud = s_config['cloud_ref'].split('#')[1]
+        s_seg = s_config['se_group_ref'].split('#')[1]
+        s_enabled = s_config['enable_state'].split('SE_STATE_')[1]
+        s_state = s_runtime['oper_status']['state'].split('OPER_')[1]
+        s_connected = ('Connected' if s_runtime['se_connected']
+                       else 'Not connected')
+        s_version = s_runtime['version']
+        s_online = s_runtime['online_since']
+        s_hs = s['health_score']['health_score']
+        s_vs = ','.join([v.split('#')[1]
+                         for v in s_config['virtualservice_refs']])
+
+        yield [s_name, s_uuid, s_tenant, s_cloud, s_seg, s_enabled, s_state,
+               s_connected, s_version, s_online, s_hs, s_vs]
+
+
+class InventorySnapshot:
+    """A compact local snapshot of previously exported inventories, holding
+    the name and a hash of the output row of each object keyed by UUID,
+    together with the latest last-modified time seen for each inventory
+    type, so that only the rows that have changed since need be output."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.snapshots = {}
+        self.latest = {}
+        if exists(filename):
+            with open(filename, 'r', encoding='UTF-8') as snapshot_file:
+                self.snapshots = json.load(snapshot_file)
+
+    def modified_since(self, inventory_type):
+        return self.snapshots.get(inventory_type, {}).get('last_modified')
+
+    def track(self, inventory_type, inventory):
+        """Yield each object in an inventory, recording the latest
+        last-modified time of the objects."""
+        latest = self.modified_since(inventory_type) or 0
+        for obj in inventory:
+            latest = max(latest,
+                         int(obj['config'].get('_last_modified', 0)))
+            yield obj
+        self.latest[inventory_type] = latest
+
+    def diff(self, inventory_type, headers, rows, existing=None):
+        """Yield each row that has been added or changed since the previous
+        snapshot, followed by a row for each object that has since been
+        removed, with the kind of change prepended to each row.
+
+        Rows are matched to the previous snapshot by a hash join on UUID.
+        If existing (the set of UUIDs of all current objects) is given,
+        rows need only include the objects modified since the previous
+        snapshot, and other existing objects are taken to be unchanged."""
+        previous = self.snapshots.get(inventory_type, {}).get('rows', {})
+        current = ({} if existing is None else
+                   {uuid: previous[uuid] for uuid in existing
+                    if uuid in previous})
+
+        for row in rows:
+            row_hash = hashlib.blake2b(json.dumps(row).encode(),
+                                       digest_size=8).hexdigest()
+            current[row[1]] = [row[0], row_hash]
+            if row[1] not in previous:
+                yield ['Added'] + row
+            elif previous[row[1]][1] != row_hash:
+                yield ['Changed'] + row
+
+        for uuid, (name, _) in previous.items():
+            if uuid not in current:
+                yield ['Removed', name, uuid] + [''] * (len(headers) - 2)
+
+        self.snapshots[inventory_type] = {
+            'last_modified': self.latest.get(inventory_type),
+            'rows': current}
+
+    def save(self):
+        with open(f'{self.filename}.tmp', 'w',
+                  encoding='UTF-8') as snapshot_file:
+            json.dump(self.snapshots, snapshot_file, separators=(',', ':'))
+        replace(f'{self.filename}.tmp', self.filename)
+
+
+def export_inventories(api, tenant, inventory_types, write,
+                       concurrency=CONCURRENCY, snapshot=None,
+                       modified_only=False):
+    """Retrieve several inventory types at the same time over one API
+    session, calling write(inventory_type, headers, rows) for each type
+    from its own thread. An inventory needed by more than one type is
+    retrieved only once and shared in memory, so that relationships
+    between Virtual Services, pools and Service Engines are linked up
+    without further API calls. Other inventories are streamed.
+
+    If a snapshot is given, only the rows added, changed or removed since
+    the snapshot are written. With modified_only, the objects of each
+    type other than pooldetail are then retrieved only if they have been
+    modified since the snapshot, along with a list of all current UUIDs
+    to identify removed objects."""
+    uses = Counter(obj for inventory_type in inventory_types
+                   for obj in INVENTORY_SOURCES[inventory_type])
+
+    with ThreadPoolExecutor(
+            max_workers=len(uses) + len(inventory_types)) as executor:
+        shared = {obj: executor.submit(
+                      lambda o: list(get_inventory(api, tenant, o)), obj)
+                  for obj, count in uses.items() if count > 1}
+
+        def inventory(obj):
+            if obj in shared:
+                return shared[obj].result()
+            return get_inventory(api, tenant, obj)
+
+        def export(inventory_type):
+            obj = INVENTORY_SOURCES[inventory_type][0]
+            headers = INVENTORY_HEADERS[inventory_type]
+            existing = None
+
+            # Pool detail rows also depend on the state of the servers and
+            # Virtual Services, which doesn't change a pool's last-modified
+            # time, so they are always retrieved in full
+
+            modified_since = (snapshot.modified_since(inventory_type)
+                              if snapshot and modified_only and
+                              inventory_type != 'pooldetail' else None)
+            if modified_since:
+                existing = {o['uuid'] for o in api.get_objects_iter(
+                    obj.split('-inventory')[0],
+                    params={'fields': 'uuid',
+                            'page_size': INVENTORY_PAGE_SIZE},
+                    tenant=tenant)}
+                objects = get_inventory(api, tenant, obj, modified_since)
+            else:
+                objects = inventory(obj)
+            if snapshot:
+                objects = snapshot.track(inventory_type, objects)
+
+            if inventory_type == 'vs':
+                rows = vs_inventory_rows(objects)
+            elif inventory_type == 'pool':
+                rows = pool_inventory_rows(api, tenant, objects)
+            elif inventory_type == 'pooldetail':
+                # Index the Service Engine placement of every Virtual
+                # Service from a single sweep of the VS inventory, rather
+                # than fetching the inventory of each pool's Virtual
+                # Services in turn
+
+                vs_se_index = vs_service_engine_index(
+                    inventory('virtualservice-inventory'))
+                rows = pool_inventory_rows(api, tenant, objects,
+                                           vs_se_index, concurrency)
+            elif inventory_type == 'se':
+                rows = se_inventory_rows(objects)
+
+            if snapshot:
+                rows = snapshot.diff(inventory_type, headers, rows, existing)
+                headers = ['Change'] + headers
+            write(inventory_type, headers, rows)
+
+        for future in [executor.submit(export, inventory_type)
+                       for inventory_type in inventory_types]:
+            future.result()
+
+
+def write_workbook(filename, tables):
+    """Write a dict of tables, each a (headers, rows) tuple keyed by sheet
+    title, to an Excel workbook with one worksheet per table."""
+    workbook = openpyxl.Workbook(write_only=True)
+    for title, (headers, rows) in tables.items():
+        sheet = workbook.create_sheet(title)
+        sheet.append(headers)
+        for row in rows:
+            sheet.append(row)
+    workbook.save(filename)
+
+
+def write_rows(filename, output_format, headers, rows):
+    """Write rows to a CSV or JSON lines file as they are produced."""
+    with open(filename, 'w', newline='', encoding='UTF-8') as output_file:
+        if output_format == 'jsonl':
+            output_file.writelines(json.dumps(dict(zip(headers, row))) + '\n'
+                                   for row in rows)
+        else:
+            csv_writer = csv.writer(output_file, dialect='excel')
+            csv_writer.writerow(headers)
+            csv_writer.writerows(rows)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter)
@@ -31,10 +414,34 @@ if __name__ == '__main__':
                         default='admin')
     parser.add_argument('-x', '--apiversion', help='Avi API version')
     parser.add_argument('-i', '--inventorytype',
-                        help='Inventory type (vs, pool, pooldetail, se)',
-                        choices=['vs', 'pool', 'pooldetail', 'se'],
+                        help='Inventory type (vs, pool, pooldetail, se), or '
+                             'a comma-separated list of types to export '
+                             'together in a single run',
                         default='vs')
-    parser.add_argument('-f', '--file', help='Output to named CSV file ')
+    parser.add_argument('-f', '--file',
+                        help='Output to named CSV, JSON lines or Excel '
+                             'file. If the filename contains {type}, each '
+                             'inventory type is written to its own file')
+    parser.add_argument('-of', '--outputformat',
+                        help='Output file format (default=csv, or jsonl/'
+                             'xlsx if the filename ends in .jsonl/.xlsx)',
+                        choices=['csv', 'jsonl', 'xlsx'])
+    parser.add_argument('-sn', '--snapshot',
+                        help='Snapshot file in which to keep a hash of each '
+                             'exported row. If given, only the rows added, '
+                             'changed or removed since the previous run are '
+                             'output')
+    parser.add_argument('-mo', '--modifiedonly',
+                        help='With a snapshot, only retrieve objects whose '
+                             'configuration has been modified since the '
+                             'previous run (changes to runtime state alone, '
+                             'such as health scores, are not detected)',
+                        action='store_true')
+    parser.add_argument('-cc', '--concurrency',
+                        help='Maximum number of pools whose servers are '
+                             'retrieved concurrently in pooldetail mode '
+                             f'(default={CONCURRENCY})',
+                        type=int, default=CONCURRENCY)
 
     args = parser.parse_args()
 
@@ -47,8 +454,37 @@ if __name__ == '__main__':
         password = args.password
         tenant = args.tenant
         api_version = args.apiversion
-        inventory_type = args.inventorytype
+        inventory_types = list(dict.fromkeys(
+            t.strip() for t in args.inventorytype.split(',') if t.strip()))
         csv_filename = args.file
+        output_format = args.outputformat or next(
+            (f for f in ('jsonl', 'xlsx')
+             if csv_filename and csv_filename.endswith(f'.{f}')), 'csv')
+        concurrency = max(args.concurrency, 1)
+        snapshot = InventorySnapshot(args.snapshot) if args.snapshot else None
+
+        invalid_types = [t for t in inventory_types
+                         if t not in INVENTORY_HEADERS]
+        if invalid_types or not inventory_types:
+            print('Invalid inventory type(s) : '
+                  f'{",".join(invalid_types)}')
+            exit()
+
+        per_type = bool(csv_filename) and '{type}' in csv_filename
+
+        if (csv_filename and not per_type and len(inventory_types) > 1
+                and output_format != 'xlsx'):
+            print('Multiple inventory types can only be written to an '
+                  'Excel workbook or to a filename containing {type}')
+            exit()
+
+        if args.modifiedonly and not snapshot:
+            print('Modified-only mode requires a snapshot file')
+            exit()
+
+        if output_format == 'xlsx' and not openpyxl:
+            print('Excel output requires the openpyxl package')
+            exit()
 
         while not controller:
             controller = input('Controller:')
@@ -65,172 +501,44 @@ if __name__ == '__main__':
             print(f'Discovered Controller version {api_version}.')
         api = ApiSession.get_session(controller, user, password,
                                      api_version=api_version)
-        output_table = []
-        headers = []
-
-        if inventory_type == 'vs':
-            vs_inventory = api.get_objects_iter('virtualservice-inventory',
-                                                params={'include_name': True},
-                                                tenant=tenant)
-            for vs in vs_inventory:
-                vs_config = vs['config']
-                vs_runtime = vs['runtime']
-                vs_name = vs_config['name']
-                vs_uuid = vs_config['uuid']
-                vs_type = vs_config['type'].split('VS_TYPE_')[1]
-                vs_seg = vs_config['se_group_ref'].split('#')[1]
-                vs_tenant = vs_config['tenant_ref'].split('#')[1]
-                vs_cloud = vs_config['cloud_ref'].split('#')[1]
-                vs_vrf = vs_config['vrf_context_ref'].split('#')[1]
-                vs_ports = [(s['port'], s['port_range_end'], s['enable_ssl'])
-                            for s in vs_config['services']]
-                vs_ports = ','.join([f'{a}' + ('' if a == b else f'-{b}') +
-                                     ('*' if c else '')
-                                     for (a, b, c) in vs_ports])
-                vs_waf = vs_config.get('waf_policy_ref', '#').split('#')[1]
-                vs_app_profile_type = vs.get('app_profile_type',
-                                             'APPLICATION_PROFILE_TYPE_UNKNOWN')
-                vs_app_type = vs_app_profile_type.split(
-                    'APPLICATION_PROFILE_TYPE_')[1]
-                all_ip_addresses = []
-                if vs_config['type'] == 'VS_TYPE_VH_CHILD':
-                    for v in vs.get('parent_vs_vip', []):
-                        all_ip_addresses.extend([v[ip_type]['addr']
-                                    for ip_type in ('ip_address', 'ip6_address')
-                                    if ip_type in v])
-                    vs_fqdns = ','.join(vs_config.get('vh_domain_name', []))
+
+        tables = {}
+
+        def write(inventory_type, headers, rows):
+            if csv_filename and (per_type or len(inventory_types) == 1):
+                # Rows are written as they are produced rather than
+                # collected first, so large inventories don't need to be
+                # held in memory
+
+                filename = csv_filename.replace('{type}', inventory_type)
+                print(f'Outputting data to {filename}')
+                if output_format == 'xlsx':
+                    write_workbook(filename,
+                                   {inventory_type: (headers, rows)})
                 else:
-                    for v in vs_config.get('vip', []):
-                        all_ip_addresses.extend([v[ip_type]['addr']
-                                    for ip_type in ('ip_address', 'ip6_address')
-                                    if ip_type in v])
-                    vs_fqdns = ','.join([d['fqdn']
-                                        for d in vs_config.get('dns_info', [])])
-                vs_vips = ','.join(all_ip_addresses)
-                vs_selist = set()
-                if 'vip_summary' in vs_runtime:
-                    for v in vs_runtime['vip_summary']:
-                        if 'service_engine' in v:
-                            vs_selist.update(s['url'].split('#')[1]
-                                             for s in v['service_engine'])
-                vs_selist = ','.join(vs_selist)
-                vs_enabled = 'Enabled' if vs_config['enabled'] else 'Disabled'
-                vs_state = vs_runtime['oper_status']['state'].split('OPER_')[1]
-                vs_hs = vs['health_score']['health_score']
-                vs_pools = ','.join([p.split('#')[1] for p in vs['pools']])
-                vs_poolgroups = ','.join([pg.split('#')[1]
-                                         for pg in vs['poolgroups']])
-                output_table.append([vs_name, vs_uuid, vs_tenant, vs_cloud,
-                                     vs_vrf, vs_type, vs_seg, vs_vips, vs_fqdns,
-                                     vs_ports, vs_pools, vs_poolgroups,
-                                     vs_app_type, vs_waf, vs_enabled,
-                                     vs_state, vs_hs, vs_selist])
-            headers = ['Name', 'UUID', 'Tenant', 'Cloud', 'VRF', 'Type', 'SEG',
-                       'VIPs', 'FQDNs', 'Ports', 'Pools', 'Pool Groups',
-                       'App Type', 'WAF', 'State', 'Oper State', 'Health Score',
-                       'Service Engines']
-        elif inventory_type in ('pool', 'pooldetail'):
-            p_inventory = api.get_objects_iter('pool-inventory',
-                                               params={'include_name': True},
-                                               tenant=tenant)
-            for p in p_inventory:
-                p_config = p['config']
-                p_runtime = p['runtime']
-                p_name = p_config['name']
-                p_uuid = p_config['uuid']
-                p_tenant = p_config['tenant_ref'].split('#')[1]
-                p_cloud = p_config['cloud_ref'].split('#')[1]
-                p_vrf = p_config['vrf_ref'].split('#')[1]
-                p_port = p_config['default_server_port']
-                p_servers = p_config['num_servers']
-                p_state = p_runtime['oper_status']['state'].split('OPER_')[1]
-                p_hs = p['health_score']['health_score']
-                p_vs = ','.join([vs.split('#')[1]
-                                 for vs in p.get('virtualservices', [])])
-
-                output = [p_name, p_uuid, p_tenant, p_cloud, p_vrf, p_port,
-                          p_servers, p_state, p_hs, p_vs]
-
-                if inventory_type == 'pooldetail':
-                    ps_inventory = api.get_objects_iter(
-                        f'pool-inventory/{p_uuid}/server',
-                        params={'include_name': True},
-                        tenant=tenant)
-                    p_servers = [(ps['config']['ip']['addr'],
-                                  ps['config']['port'],
-                                  ps['runtime']['oper_status']['state'].split(
-                        'OPER_')[1],
-                        ps['health_score']['health_score'])
-                        for ps in ps_inventory]
-
-                    output.append(','.join([f'{a}' +
-                                            (f':{b}' if b != p_port else '') +
-                                            f' [{c},{d}]'
-                                            for (a, b, c, d) in p_servers]))
-
-                    vs_selist = set()
-                    for vs in p.get('virtualservices', []):
-                        vs_uuid = vs.split('/api/virtualservice/')[1]
-                        rsp = api.get(
-                            f'virtualservice-inventory/{vs_uuid}',
-                            params={'include_name': True},
-                            tenant=tenant)
-
-                        if rsp.status_code < 300:
-                            vs_runtime = rsp.json().get('runtime', {})
-                        else:
-                            vs_runtime = {}
-
-                        if 'vip_summary' in vs_runtime:
-                            for v in vs_runtime['vip_summary']:
-                                if 'service_engine' in v:
-                                    vs_selist.update(s['url'].split('#')[1]
-                                                for s in v['service_engine'])
-                    output.append(','.join(vs_selist))
-
-                output_table.append(output)
-            headers = ['Name', 'UUID', 'Tenant', 'Cloud', 'VRF', 'Port',
-                       '#Servers', 'State', 'Health Score', 'Virtual Services']
-            if inventory_type == 'pooldetail':
-                headers.extend(['Servers', 'Service Engines'])
-        elif inventory_type == 'se':
-            s_inventory = api.get_objects_iter('serviceengine-inventory',
-                                               params={'include_name': True},
-                                               tenant=tenant)
-            for s in s_inventory:
-                s_config = s['config']
-                s_runtime = s['runtime']
-                s_name = s_config['name']
-                s_uuid = s_config['uuid']
-                s_tenant = s_config['tenant_ref'].split('#')[1]
-                s_cloud = s_config['cloud_ref'].split('#')[1]
-                s_seg = s_config['se_group_ref'].split('#')[1]
-                s_enabled = s_config['enable_state'].split('SE_STATE_')[1]
-                s_state = s_runtime['oper_status']['state'].split('OPER_')[1]
-                s_connected = ('Connected' if s_runtime['se_connected']
-                               else 'Not connected')
-                s_version = s_runtime['version']
-                s_online = s_runtime['online_since']
-                s_hs = s['health_score']['health_score']
-                s_vs = ','.join([v.split('#')[1]
-                                 for v in s_config['virtualservice_refs']])
-
-                output_table.append([s_name, s_uuid, s_tenant, s_cloud, s_seg,
-                                     s_enabled, s_state, s_connected, s_version,
-                                     s_online, s_hs, s_vs])
-
-            headers = ['Name', 'UUID', 'Tenant', 'Cloud', 'SEG', 'State',
-                       'Oper State', 'Connectivity', 'Version', 'Online Since',
-                       'Health Score', 'Virtual Services']
-        if csv_filename:
+                    write_rows(filename, output_format, headers, rows)
+            else:
+                tables[inventory_type] = (headers, list(rows))
+
+        export_inventories(api, tenant, inventory_types, write, concurrency,
+                           snapshot, args.modifiedonly)
+
+        # Tables are output in the order in which the inventory types were
+        # requested, regardless of which was retrieved first
+
+        tables = {t: tables[t] for t in inventory_types if t in tables}
+
+        if csv_filename and tables:
             print(f'Outputting data to {csv_filename}')
-            with open(csv_filename, 'w',
-                      newline='', encoding='UTF-8') as csv_file:
-                csv_writer = csv.writer(csv_file, dialect='excel')
-                csv_writer.writerow(headers)
-                csv_writer.writerows(output_table)
+            write_workbook(csv_filename, tables)
         else:
-            print(tabulate(output_table, headers=headers, tablefmt='outline'))
+            for inventory_type, (headers, rows) in tables.items():
+                if len(tables) > 1:
+                    print(f'{inventory_type} inventory:')
+                print(tabulate(rows, headers=headers, tablefmt='outline'))
+
+        if snapshot:
+            snapshot.save()
 
     else:
         parser.print_help()
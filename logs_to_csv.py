@@ -1,17 +1,40 @@
 #!/usr/bin/env python
 
-"""Script to export Virtual Service Client Logs to a CSV file."""
+"""Script to export Virtual Service Client Logs to a CSV or Parquet file."""
 
 import argparse
+import codecs
 import csv
 import getpass
+import json
+import re
+import shutil
+import sys
+import threading
 import time
-from datetime import datetime, timezone
-from os import devnull
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from fnmatch import fnmatch
+from functools import partial
+from os import devnull, remove, replace
+from os.path import exists
 
 import requests
 import urllib3
-from avi.sdk.avi_api import ApiSession
+from avi.sdk.avi_api import ApiSession, APIError
+from tabulate import tabulate
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # Disable certificate warnings
 
@@ -21,8 +44,887 @@ if hasattr(requests.packages.urllib3, 'disable_warnings'):
 if hasattr(urllib3, 'disable_warnings'):
     urllib3.disable_warnings()
 
+PAGE_SIZE = 10000
+JSON_CHUNK_SIZE = 64 * 1024
+
+_json_decoder = json.JSONDecoder()
+_json_whitespace = re.compile(r'[ \t\n\r]*')
+_json_delimiters = frozenset(' \t\n\r,:]}')
+
+# Values starting with these characters could be interpreted as formulae
+# by spreadsheet applications so are escaped with a leading quote.
+FORMULA_PREFIXES = ('+', '-', '=')
+
+PARQUET_COMPRESSION = 'zstd'
+
+INDEX_POLL_MIN = 0.5
+INDEX_POLL_MAX = 30
+
+FOLLOW_POLL_INTERVAL = 10
+FOLLOW_LAG = 5
+FOLLOW_WINDOW = 60
+FOLLOW_WINDOW_MIN = 1
+FOLLOW_WINDOW_MAX = 3600
+FOLLOW_KEY_FIELDS = ('report_timestamp', 'service_engine', 'log_id')
+
+GZIP_LEVEL = 1
+ZSTD_LEVEL = 3
+COMPRESS_BUFFER_SIZE = 256 * 1024
+COMPRESSION_SUFFIXES = {'.gz': 'gzip', '.zst': 'zstd'}
+
+_query_id_lock = threading.Lock()
+_last_query_id = 0
+
+
+class TransferStats:
+    """Running totals of the log data received from the Controller,
+    shared by all worker threads."""
+
+    def __init__(self):
+        self.bytes = 0
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, byte_count):
+        with self._lock:
+            self.bytes += byte_count
+
+    def summary(self, logs):
+        elapsed = max(time.monotonic() - self.started, 0.001)
+        return (f'{self.bytes / 1048576:,.1f} MB received in {elapsed:,.1f}s '
+                f'({logs / elapsed:,.0f} logs/sec)')
+
+
+transfer_stats = TransferStats()
+
+
 def get_query_id():
-    return int(100*datetime.now().timestamp())
+    """Return a unique, time-based query ID. Safe to call from multiple
+    worker threads - concurrent callers never receive the same ID."""
+    global _last_query_id
+
+    with _query_id_lock:
+        _last_query_id = max(_last_query_id + 1,
+                             int(100*datetime.now().timestamp()))
+        return _last_query_id
+
+
+class JsonStream:
+    """Minimal incremental JSON reader over an iterable of byte chunks,
+    e.g. the iter_content() of a streamed response. Only as much of the
+    document as is needed to decode the next value is held in memory."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        if self._eof:
+            raise ValueError('Unexpected end of JSON data')
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            self._eof = True
+            text = self._decoder.decode(b'', final=True)
+        else:
+            text = self._decoder.decode(chunk)
+        self._buf = self._buf[self._pos:] + text
+        self._pos = 0
+
+    def peek(self):
+        """Return the next non-whitespace character without consuming it."""
+        while True:
+            self._pos = _json_whitespace.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            self._fill()
+
+    def expect(self, char):
+        """Consume the next non-whitespace character, which must be char."""
+        if self.peek() != char:
+            raise ValueError(f'Expected {char!r} in JSON data')
+        self._pos += 1
+
+    def value(self):
+        """Decode and return the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                obj, end = _json_decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+                self._fill()
+                continue
+            if not self._eof and (end == len(self._buf) or
+                                  self._buf[end] not in _json_delimiters):
+                # A number or literal could continue into the next chunk
+                self._fill()
+                continue
+            self._pos = end
+            return obj
+
+
+def iter_json_array(chunks, key, extras=None):
+    """Yield each item of the array stored under key in a streamed JSON
+    object as soon as it has been decoded. Any other top-level members are
+    stored in the extras dict if one is provided."""
+    stream = JsonStream(chunks)
+    stream.expect('{')
+    if stream.peek() == '}':
+        return
+
+    while True:
+        name = stream.value()
+        stream.expect(':')
+        if name == key:
+            stream.expect('[')
+            if stream.peek() == ']':
+                stream.expect(']')
+            else:
+                while True:
+                    yield stream.value()
+                    if stream.peek() != ',':
+                        stream.expect(']')
+                        break
+                    stream.expect(',')
+        else:
+            value = stream.value()
+            if extras is not None:
+                extras[name] = value
+        if stream.peek() != ',':
+            stream.expect('}')
+            return
+        stream.expect(',')
+
+
+def make_row_projector(field_names, escape=True):
+    """Build a function which converts a log entry into a list of values in
+    the order given by field_names, with fields missing from the entry set
+    to None.
+
+    The field positions are resolved once up front and only the fields
+    actually present in each entry are visited, which is much faster than
+    looking up every known field name as log entries are typically sparse.
+    If escape is True, values that could be interpreted as spreadsheet
+    formulae are prefixed with a quote, converting each value to a string
+    at most once."""
+    field_index = {f: n for n, f in enumerate(field_names)}.get
+    empty_row = [None] * len(field_names)
+
+    def project(res):
+        row = empty_row.copy()
+        for field, value in res.items():
+            n = field_index(field)
+            if n is None or value is None:
+                continue
+            if escape:
+                value_type = value.__class__
+                if value_type is str:
+                    if value.lstrip()[:1] in FORMULA_PREFIXES:
+                        value = "'" + value
+                elif value_type is int:
+                    if value < 0:
+                        value = "'" + str(value)
+                elif value_type is float:
+                    # Checking the string rather than value < 0 also
+                    # escapes -0.0
+
+                    text = str(value)
+                    if text[0] == '-':
+                        value = "'" + text
+                elif value_type is not bool:
+                    text = str(value)
+                    if text.lstrip()[:1] in FORMULA_PREFIXES:
+                        value = "'" + text
+            row[n] = value
+        return row
+
+    return project
+
+
+def get_compressor(compression):
+    """Return a new streaming compressor object for the given compression
+    type which produces a single gzip member or zstd frame."""
+    if compression == 'gzip':
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED,
+                                16 + zlib.MAX_WBITS)
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+
+class CompressedFile:
+    """Minimal writable text file which compresses its content as it is
+    written, so the uncompressed data never exists on disk.
+
+    Each flush() completes the current gzip member or zstd frame. Both
+    formats allow members/frames to be concatenated, so the file is valid
+    up to the last flush and can later be truncated back to that point
+    and appended to."""
+
+    def __init__(self, filename, compression):
+        self._file = open(filename, 'ab')
+        self._compression = compression
+        self._compressor = None
+        self._pending = []
+        self._pending_size = 0
+
+    def write(self, text):
+        self._pending.append(text)
+        self._pending_size += len(text)
+        if self._pending_size >= COMPRESS_BUFFER_SIZE:
+            self._compress_pending()
+
+    def _compress_pending(self):
+        if self._compressor is None:
+            self._compressor = get_compressor(self._compression)
+        self._file.write(self._compressor.compress(
+            ''.join(self._pending).encode('UTF-8')))
+        self._pending.clear()
+        self._pending_size = 0
+
+    def flush(self):
+        if self._pending:
+            self._compress_pending()
+        if self._compressor is not None:
+            self._file.write(self._compressor.flush())
+            self._compressor = None
+        self._file.flush()
+
+    def tell(self):
+        return self._file.tell()
+
+    def seek(self, offset, whence=0):
+        return self._file.seek(offset, whence)
+
+    def truncate(self, size):
+        return self._file.truncate(size)
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+class CsvSink:
+    """Writes log rows to a CSV file, optionally compressed.
+
+    The file is opened in append mode and, if size is given, truncated to
+    that size first so that a resumed export discards anything written
+    after the last checkpoint."""
+
+    escape = True
+
+    def __init__(self, filename, field_names, size=None, header=True,
+                 compression=None):
+        if compression:
+            self._file = CompressedFile(filename, compression)
+        else:
+            self._file = open(filename, 'a', newline='', encoding='UTF-8')
+        if size is not None:
+            self._file.truncate(size)
+            self._file.seek(0, 2)
+        self.writerow = csv.writer(self._file, dialect='excel').writerow
+        if header and size == 0:
+            self.writerow(field_names)
+
+    def commit(self):
+        """Flush all rows written so far and return the file size."""
+        self._file.flush()
+        return self._file.tell()
+
+    def close(self):
+        self._file.close()
+
+    @staticmethod
+    def stitch(filename, part_filenames, field_names, compression=None):
+        """Concatenate part files into a single CSV file with a header.
+        Compressed parts are concatenated as-is without recompressing."""
+        header_sink = CsvSink(filename, field_names, size=0,
+                              compression=compression)
+        header_sink.close()
+        with open(filename, 'ab') as csv_file:
+            for part_filename in part_filenames:
+                with open(part_filename, 'rb') as part_file:
+                    shutil.copyfileobj(part_file, csv_file)
+
+
+class StdoutSink(CsvSink):
+    """Writes log rows as CSV to the original standard output, even if
+    sys.stdout has since been redirected."""
+
+    def __init__(self, field_names, header=True):
+        self._file = sys.__stdout__
+        self.writerow = csv.writer(self._file, dialect='excel').writerow
+        if header:
+            self.writerow(field_names)
+
+    def commit(self):
+        self._file.flush()
+        return 0
+
+    def close(self):
+        self._file.flush()
+
+
+class ListSink:
+    """Collects log rows in memory."""
+
+    escape = True
+
+    def __init__(self):
+        self.rows = []
+        self.writerow = self.rows.append
+
+
+class ParquetSchema:
+    """Column types shared by all the Parquet files of an export.
+
+    Types are inferred from the first page of logs written by any slice,
+    with columns that are empty in that page, or whose values have mixed
+    types, stored as strings. If a later value doesn't fit its column's
+    type, the column is widened (integers to doubles, anything else to
+    strings) rather than losing the value, and files already written with
+    the narrower type are cast to the widened schema. Nested values are
+    stored as JSON strings."""
+
+    ARROW_ERRORS = (pa.ArrowInvalid, pa.ArrowTypeError,
+                    pa.ArrowNotImplementedError, OverflowError) if pa else ()
+
+    def __init__(self, field_names):
+        self.field_names = field_names
+        self.widened = {}
+        self._types = None
+        self._lock = threading.Lock()
+
+    @property
+    def schema(self):
+        with self._lock:
+            types = self._types or [pa.string()] * len(self.field_names)
+            return pa.schema(list(zip(self.field_names, types)))
+
+    def _infer_type(self, values):
+        try:
+            value_type = pa.array(values).type
+        except self.ARROW_ERRORS:
+            return pa.string()
+        return pa.string() if pa.types.is_null(value_type) else value_type
+
+    @staticmethod
+    def _array(values, value_type):
+        if pa.types.is_string(value_type):
+            try:
+                return pa.array(values, type=value_type)
+            except ParquetSchema.ARROW_ERRORS:
+                return pa.array([None if v is None else str(v)
+                                 for v in values], type=value_type)
+
+        # Values are converted with their own inferred type, which must be
+        # the column's type apart from integers in floating point columns,
+        # as converting directly to the column's type silently truncates
+        # floats in integer columns and turns numbers into booleans
+
+        array = pa.array(values)
+        if array.type != value_type and not pa.types.is_null(array.type) \
+                and not (pa.types.is_integer(array.type) and
+                         pa.types.is_floating(value_type)):
+            raise pa.ArrowInvalid(f'{array.type} values in a {value_type} '
+                                  f'column')
+        return array.cast(value_type, safe=True)
+
+    def _widen(self, n, value_type, values):
+        """Widen the type of column n, unless another thread has already
+        changed it from value_type, and return its new type."""
+        with self._lock:
+            if self._types[n] == value_type:
+                if pa.types.is_integer(value_type) and all(
+                        isinstance(v, (int, float)) and
+                        not isinstance(v, bool)
+                        for v in values if v is not None):
+                    self._types[n] = pa.float64()
+                else:
+                    self._types[n] = pa.string()
+                self.widened[self.field_names[n]] = self._types[n]
+            return self._types[n]
+
+    def to_table(self, rows):
+        columns = [[json.dumps(v) if isinstance(v, (dict, list)) else v
+                    for v in column] for column in zip(*rows)]
+
+        with self._lock:
+            if self._types is None:
+                self._types = [self._infer_type(c) for c in columns]
+            types = list(self._types)
+
+        arrays = []
+        for n, column in enumerate(columns):
+            while True:
+                try:
+                    arrays.append(self._array(column, types[n]))
+                    break
+                except self.ARROW_ERRORS:
+                    types[n] = self._widen(n, types[n], column)
+
+        # Another thread may have widened other columns in the meantime
+
+        schema = self.schema
+        return pa.Table.from_arrays(arrays, names=self.field_names).cast(
+            schema)
+
+
+class ParquetSink:
+    """Writes log rows to a Parquet file as one compressed row group per
+    page of logs. Parquet files cannot be appended to, so any existing
+    file is overwritten.
+
+    A Parquet file has a single schema, so if a column is widened after
+    row groups have been written, the file written so far is rewritten
+    with the widened schema."""
+
+    escape = False
+
+    def __init__(self, filename, field_names, size=None, header=True,
+                 schema=None):
+        self._filename = filename
+        self._schema = schema or ParquetSchema(field_names)
+        self._rows = []
+        self._writer = None
+        self.writerow = self._rows.append
+
+    def _open(self, schema):
+        """Open the file for writing with schema, copying any row groups
+        already written to it cast to the new schema."""
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self._filename, schema,
+                                            compression=PARQUET_COMPRESSION)
+            return
+        self._writer.close()
+        replace(self._filename, f'{self._filename}.tmp')
+        self._writer = pq.ParquetWriter(self._filename, schema,
+                                        compression=PARQUET_COMPRESSION)
+        ParquetSink.copy(f'{self._filename}.tmp', self._writer, schema)
+        remove(f'{self._filename}.tmp')
+
+    def commit(self):
+        """Write all rows received so far as a row group."""
+        if self._rows:
+            table = self._schema.to_table(self._rows)
+            if self._writer is None or table.schema != self._writer.schema:
+                self._open(table.schema)
+            self._writer.write_table(table)
+            self._rows.clear()
+        return 0
+
+    def close(self):
+        self.commit()
+        if self._writer is None:
+            self._open(self._schema.schema)
+        self._writer.close()
+
+    @staticmethod
+    def copy(filename, writer, schema):
+        """Copy the row groups of a Parquet file to writer, cast to
+        schema."""
+        parquet_file = pq.ParquetFile(filename)
+        for n in range(parquet_file.num_row_groups):
+            writer.write_table(parquet_file.read_row_group(n).cast(schema))
+
+    @staticmethod
+    def stitch(filename, part_filenames, schema):
+        """Merge the row groups of the part files into a single file, cast
+        to the final schema as parts which were completed before a column
+        was widened have the narrower type."""
+        final_schema = schema.schema
+        with pq.ParquetWriter(filename, final_schema,
+                              compression=PARQUET_COMPRESSION) as writer:
+            for part_filename in part_filenames:
+                ParquetSink.copy(part_filename, writer, final_schema)
+
+
+def split_time_range(start, end, count):
+    """Split the time range [start, end) into count contiguous sub-ranges
+    of equal duration, oldest first."""
+    step = (end - start) / count
+    bounds = [start + step * n for n in range(count)] + [end]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def find_virtual_services(api, tenant, vs_names):
+    """Return a list of (name, uuid) tuples for the Virtual Services
+    matching a comma-separated list of names and/or glob patterns. A single
+    name is looked up directly, otherwise all Virtual Services are listed
+    once and matched against each pattern."""
+    patterns = [n for n in vs_names.split(',') if n]
+
+    if len(patterns) == 1 and not any(c in patterns[0] for c in '*?['):
+        vs_obj = api.get_object_by_name('virtualservice', name=patterns[0],
+                                        tenant=tenant,
+                                        params={'fields': 'uuid'})
+        return [(patterns[0], vs_obj['uuid'])] if vs_obj else []
+
+    vs_list = [(vs['name'], vs['uuid'])
+               for vs in api.get_objects_iter('virtualservice',
+                                              params={'fields': 'name,uuid'},
+                                              tenant=tenant)]
+    return [(vs_name, vs_uuid) for vs_name, vs_uuid in vs_list
+            if any(fnmatch(vs_name, pattern) for pattern in patterns)]
+
+
+def timed_call(fn, *args):
+    """Call fn, returning a tuple of its result and the start and finish
+    times of the call."""
+    started = time.monotonic()
+    result = fn(*args)
+    return result, started, time.monotonic()
+
+
+class Checkpoint:
+    """Records the progress of an export to a single output file so that an
+    interrupted export can later be resumed from where it stopped.
+
+    An export consists of one or more time slices for each of one or more
+    Virtual Services. For each slice, the checkpoint holds the paging
+    cursor (the report_timestamp of the oldest log written so far), the
+    number of logs written and the size of the slice's output file at that
+    point. The checkpoint is only updated after a page has been flushed to
+    disk, so anything beyond the recorded size can safely be discarded on
+    resume."""
+
+    def __init__(self, filename, state):
+        self.filename = filename
+        self.state = state
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, filename, output, query, field_names, vs_list,
+               time_slices):
+        state = {'output': output,
+                 'query': query,
+                 'field_names': field_names,
+                 'slices': [{'name': vs_name,
+                             'virtualservice': vs_uuid,
+                             'start': start.isoformat(),
+                             'end': end.isoformat(),
+                             'cursor': end.isoformat(),
+                             'logs': 0, 'size': 0, 'complete': False}
+                            for vs_name, vs_uuid in vs_list
+                            for start, end in time_slices]}
+        return cls(filename, state)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'r', encoding='UTF-8') as checkpoint_file:
+            return cls(filename, json.load(checkpoint_file))
+
+    @property
+    def slices(self):
+        return self.state['slices']
+
+    def update(self, n, **kwargs):
+        with self._lock:
+            self.slices[n].update(kwargs)
+            self.save()
+
+    def save(self):
+        if not self.filename:
+            return
+        with open(f'{self.filename}.tmp', 'w',
+                  encoding='UTF-8') as checkpoint_file:
+            json.dump(self.state, checkpoint_file)
+        replace(f'{self.filename}.tmp', self.filename)
+
+    def remove(self):
+        if self.filename and exists(self.filename):
+            remove(self.filename)
+
+    def part_filenames(self):
+        """Return the part files of the export in output order, i.e. by
+        Virtual Service and then newest slice first."""
+        slice_count = len(self.slices)
+        vs_order = list(dict.fromkeys(s['virtualservice']
+                                      for s in self.slices))
+        return [slice_filename(self.state['output'], n, slice_count)
+                for n in sorted(range(slice_count),
+                                key=lambda n: (vs_order.index(
+                                    self.slices[n]['virtualservice']), -n))]
+
+
+def wait_for_indexing(api, tenant, params, start, end, label=''):
+    """Wait for the logs in the range [start, end) to be indexed.
+
+    We repeatedly request a single log entry from the range and the
+    Controller returns a percent_remaining field which indicates the
+    percentage of logs within the range still to be indexed. The indexing
+    rate is estimated from successive samples and we sleep for the
+    predicted time remaining (backing off if no progress is being made),
+    bounded by INDEX_POLL_MIN and INDEX_POLL_MAX.
+
+    Returns True once the logs are indexed or False if an error occurs."""
+    params = dict(params)
+    params['start'] = start.isoformat(timespec='milliseconds')
+    params['end'] = end.isoformat(timespec='milliseconds')
+    params['page_size'] = 1
+
+    last_time = last_percent = delay = None
+
+    while True:
+        params['query_id'] = get_query_id()
+
+        r = api.get('analytics/logs', tenant=tenant, params=params)
+        if r.status_code != 200:
+            print(f'  {label}Error while waiting for log indexing : '
+                  f'giving up!')
+            return False
+
+        percent_remaining = r.json()['percent_remaining']
+        if percent_remaining == 0.0:
+            print(f'  {label}Logs are indexed')
+            return True
+
+        now = time.monotonic()
+        if last_percent and last_percent > percent_remaining:
+            rate = (last_percent - percent_remaining) / (now - last_time)
+            delay = percent_remaining / rate
+        elif delay:
+            delay *= 2
+        else:
+            delay = percent_remaining / 10
+        delay = min(max(delay, INDEX_POLL_MIN), INDEX_POLL_MAX)
+        last_time, last_percent = now, percent_remaining
+
+        print(f'  {label}Logs are being indexed : {percent_remaining}% '
+              f'remaining, checking again in {delay:.1f}s...')
+        time.sleep(delay)
+
+
+def export_logs(api, tenant, params, field_names, start, end, sink,
+                label='', on_page=None, max_logs=None):
+    """Retrieve all logs in the range [start, end) and write them to
+    sink, newest first.
+
+    Logs are retrieved a page at a time, moving the end of the requested
+    range back to the timestamp of the oldest log received so far. Each
+    page is streamed and decoded incrementally so that rows are written as
+    soon as they arrive and memory use does not depend on the page size.
+    Each call uses its own copy of params so multiple ranges can be
+    exported concurrently over the same session.
+
+    If provided, on_page is called after each page has been written with
+    the new end of the range and the running total of logs written. If
+    max_logs is given, no more pages are requested once that many logs
+    have been written, and the range is treated as incomplete.
+
+    Returns a tuple of the number of logs written and whether the range
+    was exported completely."""
+    params = dict(params)
+    params['start'] = start.isoformat(timespec='milliseconds')
+    project = make_row_projector(field_names, escape=sink.escape)
+
+    total_logs = 0
+
+    while True:
+        print(f':: {label}Retrieving up to {params["page_size"]:,} logs from '
+              f'{start:%c %Z} to {end:%c %Z}...')
+
+        params['query_id'] = get_query_id()
+        params['end'] = end.isoformat(timespec='milliseconds')
+
+        r = api.get('analytics/logs', tenant=tenant, params=params,
+                    stream=True)
+        if r.status_code != 200:
+            print(f':: {label}Error {r.status_code} occurred : giving up!')
+            r.close()
+            return total_logs, False
+
+        res_count = 0
+
+        with r:
+            for res in iter_json_array(r.iter_content(JSON_CHUNK_SIZE),
+                                       'results'):
+                sink.writerow(project(res))
+                res_count += 1
+                last_entry = res['report_timestamp']
+            # Bytes read from the wire, i.e. before any content decoding
+            transfer_stats.add(r.raw.tell())
+
+        if res_count == 0:
+            print(f':: {label}No more logs available')
+            return total_logs, True
+
+        print(f'  {label}Got {res_count} logs')
+        total_logs += res_count
+        end = datetime.fromisoformat(last_entry)
+        if on_page:
+            on_page(end, total_logs)
+        if max_logs and total_logs >= max_logs:
+            return total_logs, False
+
+
+def follow_logs(api, tenant, params, field_names, vs_list, sinks, start,
+                poll_interval=FOLLOW_POLL_INTERVAL):
+    """Continuously export new logs for each Virtual Service in vs_list to
+    its sink in sinks until interrupted, polling every poll_interval
+    seconds.
+
+    For each Virtual Service we keep a high-water mark holding the
+    report_timestamp of the newest log written so far, initially start. The
+    new logs are written oldest first. Logs at exactly the high-water mark
+    may be returned by more than one poll, so we remember which of those
+    have already been written and skip them.
+
+    Since logs are returned newest first, each range of logs is collected
+    in memory before being written. To bound this when starting from well
+    in the past, each poll requests at most a window of logs following
+    those already retrieved, up to FOLLOW_LAG seconds ago, and the
+    following poll is made straight away while behind. The window is
+    halved if it held more than a page of logs and doubled (up to
+    FOLLOW_WINDOW_MAX seconds) if it held less than half a page. If a
+    window turns out to hold more than two pages of logs, it is abandoned
+    and retried straight away with a quarter of the window.
+
+    API and connection errors are reported and the range is retried at the
+    next poll, so that a transient error doesn't end a long-running
+    export.
+
+    Returns the total number of logs written."""
+    # The fields needed to track the high-water mark are always collected,
+    # even if they have not been selected for output.
+
+    output_width = len(field_names)
+    field_names = field_names + [f for f in FOLLOW_KEY_FIELDS
+                                 if f not in field_names]
+    timestamp_index = field_names.index('report_timestamp')
+    key_indexes = [field_names.index(f) for f in FOLLOW_KEY_FIELDS]
+    marks = {vs_uuid: (start, set()) for _, vs_uuid in vs_list}
+    fetched = {vs_uuid: start for _, vs_uuid in vs_list}
+    windows = {vs_uuid: FOLLOW_WINDOW for _, vs_uuid in vs_list}
+    total_logs = 0
+
+    try:
+        while True:
+            poll_started = time.monotonic()
+            end = datetime.now(timezone.utc) - timedelta(seconds=FOLLOW_LAG)
+            behind = False
+
+            for vs_name, vs_uuid in vs_list:
+                since = fetched[vs_uuid]
+                if end <= since:
+                    continue
+                window_end = min(end, since +
+                                 timedelta(seconds=windows[vs_uuid]))
+
+                label = f'[{vs_name}] ' if len(vs_list) > 1 else ''
+                vs_params = dict(params, virtualservice=vs_uuid)
+
+                try:
+                    if not wait_for_indexing(api, tenant, vs_params, since,
+                                             window_end, label):
+                        continue
+
+                    collector = ListSink()
+                    max_logs = (params['page_size'] * 2
+                                if windows[vs_uuid] > FOLLOW_WINDOW_MIN
+                                else None)
+                    _, complete = export_logs(api, tenant, vs_params,
+                                              field_names, since,
+                                              window_end, collector, label,
+                                              max_logs=max_logs)
+                except (APIError, requests.exceptions.RequestException) as e:
+                    print(f':: {label}Error while following logs : {e}, '
+                          f'retrying at the next poll')
+                    continue
+                if not complete:
+                    if max_logs and len(collector.rows) >= max_logs:
+                        windows[vs_uuid] = max(windows[vs_uuid] / 4,
+                                               FOLLOW_WINDOW_MIN)
+                        behind = True
+                    continue
+
+                mark, seen = marks[vs_uuid]
+                sink = sinks[vs_uuid]
+                for row in reversed(collector.rows):
+                    timestamp = datetime.fromisoformat(row[timestamp_index])
+                    key = tuple(row[n] for n in key_indexes)
+                    if timestamp < mark or (timestamp == mark and
+                                            key in seen):
+                        continue
+                    if timestamp > mark:
+                        mark, seen = timestamp, set()
+                    seen.add(key)
+                    sink.writerow(row[:output_width])
+                    total_logs += 1
+                sink.commit()
+                marks[vs_uuid] = (mark, seen)
+                fetched[vs_uuid] = window_end
+
+                if len(collector.rows) > params['page_size']:
+                    windows[vs_uuid] = max(windows[vs_uuid] / 2,
+                                           FOLLOW_WINDOW_MIN)
+                elif len(collector.rows) < params['page_size'] / 2:
+                    windows[vs_uuid] = min(windows[vs_uuid] * 2,
+                                           FOLLOW_WINDOW_MAX)
+                behind = behind or window_end < end
+
+            if not behind:
+                time.sleep(max(poll_interval -
+                               (time.monotonic() - poll_started), 0))
+    except KeyboardInterrupt:
+        pass
+
+    return total_logs
+
+
+def slice_filename(filename, n, slice_count):
+    """Return the name of the file that time slice n is written to."""
+    if slice_count == 1 or filename == devnull:
+        return filename
+    return f'{filename}.part{n}'
+
+
+def export_slice(api, tenant, params, checkpoint, n, open_sink, label=''):
+    """Wait for time slice n of the checkpointed export to be indexed and
+    then export it to a sink created by open_sink, continuing from the
+    slice's checkpointed cursor and output file size.
+
+    Returns a tuple of the number of logs in the slice and whether the
+    slice was exported completely."""
+    slice_state = checkpoint.slices[n]
+    field_names = checkpoint.state['field_names']
+    slice_count = len(checkpoint.slices)
+    params = dict(params, virtualservice=slice_state['virtualservice'])
+
+    if slice_state['complete']:
+        return slice_state['logs'], True
+
+    if not wait_for_indexing(api, tenant, params,
+                             datetime.fromisoformat(slice_state['start']),
+                             datetime.fromisoformat(slice_state['cursor']),
+                             label):
+        return slice_state['logs'], False
+
+    sink = open_sink(slice_filename(checkpoint.state['output'], n,
+                                    slice_count),
+                     field_names,
+                     size=slice_state['size'] if checkpoint.filename else None,
+                     header=slice_count == 1)
+    base_logs = slice_state['logs']
+
+    def on_page(cursor, logs):
+        checkpoint.update(n, cursor=cursor.isoformat(),
+                          logs=base_logs + logs, size=sink.commit())
+
+    try:
+        slice_logs, complete = export_logs(
+            api, tenant, params, field_names,
+            datetime.fromisoformat(slice_state['start']),
+            datetime.fromisoformat(slice_state['cursor']),
+            sink, label, on_page)
+    finally:
+        sink.close()
+
+    checkpoint.update(n, complete=complete)
+    return base_logs + slice_logs, complete
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -36,6 +938,15 @@ if __name__ == '__main__':
                         default='admin')
     parser.add_argument('-x', '--apiversion', help='Avi API version')
     parser.add_argument('-f', '--filename', help='Output to named CSV file')
+    parser.add_argument('-of', '--outputformat',
+                        help='Output file format (default=csv, or parquet '
+                             'if the filename ends in .parquet)',
+                        choices=['csv', 'parquet'])
+    parser.add_argument('-z', '--compress',
+                        help='Compress CSV output as it is written (default='
+                             'gzip if the filename ends in .gz or zstd if '
+                             'the filename ends in .zst)',
+                        choices=['gzip', 'zstd'])
     parser.add_argument('-in', '--includenonsignificantlogs',
                         help='Include non-significant logs',
                         action='store_true')
@@ -47,14 +958,50 @@ if __name__ == '__main__':
                         action='store_true')
     parser.add_argument('-fs', '--filterstring', help='Filter String',
                         action='append')
+    parser.add_argument('-fl', '--fields',
+                        help='Comma-separated list of log fields to export '
+                             '(default=all fields)')
+    parser.add_argument('-w', '--workers',
+                        help='Split the time range into this many slices '
+                             'and retrieve them concurrently (default=1). '
+                             'With a single slice, no logs are exported '
+                             'until the whole time range has been indexed',
+                        type=int, default=1)
+    parser.add_argument('-cc', '--concurrency',
+                        help='Maximum number of time slices retrieved '
+                             'concurrently across all Virtual Services '
+                             '(default=number of workers)',
+                        type=int)
+    parser.add_argument('-r', '--resume',
+                        help='Resume an interrupted export to the named CSV '
+                             'file from its checkpoint',
+                        action='store_true')
+    parser.add_argument('-F', '--follow',
+                        help='Continuously export new logs from startdatetime '
+                             'onwards until interrupted, to the named CSV '
+                             'file or to stdout',
+                        action='store_true')
+    parser.add_argument('-pi', '--pollinterval',
+                        help='Polling interval in seconds when following '
+                             f'logs (default={FOLLOW_POLL_INTERVAL})',
+                        type=float, default=FOLLOW_POLL_INTERVAL)
+    parser.add_argument('-ps', '--pagesize',
+                        help='Number of logs to request per API call '
+                             f'(default={PAGE_SIZE})',
+                        type=int, default=PAGE_SIZE)
     parser.add_argument('virtualservice',
-                        help='Name of the Virtual Service')
+                        help='Name of the Virtual Service, or a comma-'
+                             'separated list of names and/or glob patterns. '
+                             'If the filename contains {vs}, each Virtual '
+                             'Service is written to its own file, otherwise '
+                             'all logs are written to a single file')
     parser.add_argument('startdatetime',
                         help='Start date and time for exported logs '
                              'in ISO8601 format, e.g. 2024-01-01T00:00.')
-    parser.add_argument('enddatetime',
-                        help='Start date and time for exported logs '
-                             'in ISO8601 format, e.g. 2024-01-01T00:00.')
+    parser.add_argument('enddatetime', nargs='?',
+                        help='End date and time for exported logs '
+                             'in ISO8601 format, e.g. 2024-01-01T00:00. '
+                             'Not required with --follow.')
 
     args = parser.parse_args()
 
@@ -67,9 +1014,53 @@ if __name__ == '__main__':
         password = args.password
         tenant = args.tenant
         api_version = args.apiversion
-        vs_name = args.virtualservice
-        filename = args.filename or devnull
+        vs_names = args.virtualservice
+        follow = args.follow
+        filename = args.filename or ('-' if follow else devnull)
+
+        # When following logs to stdout, progress messages are sent to
+        # stderr instead.
+
+        if follow and filename == '-':
+            sys.stdout = sys.stderr
+
         filterstrings = args.filterstring
+        selected_fields = args.fields.split(',') if args.fields else None
+        workers = max(args.workers, 1)
+        concurrency = max(args.concurrency or workers, 1)
+        page_size = max(args.pagesize, 1)
+        resume = args.resume
+        output_format = args.outputformat or (
+            'parquet' if filename.endswith('.parquet') else 'csv')
+
+        compression = args.compress or next(
+            (c for suffix, c in COMPRESSION_SUFFIXES.items()
+             if filename.endswith(suffix)), None)
+
+        if follow and (resume or output_format != 'csv'):
+            print('Follow mode only supports CSV output and cannot be '
+                  'resumed')
+            exit()
+
+        if output_format == 'parquet' and not pq:
+            print('Parquet output requires the pyarrow package')
+            exit()
+
+        if output_format == 'csv' and compression == 'zstd' and not zstandard:
+            print('zstd compression requires the zstandard package')
+            exit()
+
+        # Parquet files can't be appended to, so Parquet exports are not
+        # checkpointed.
+
+        checkpointed = filename != devnull and output_format == 'csv'
+        per_vs = '{vs}' in filename
+
+        if resume and not (checkpointed and
+                           (per_vs or exists(f'{filename}.checkpoint'))):
+            print('Unable to resume : no checkpoint found for the named '
+                  'CSV file (Parquet exports cannot be resumed)')
+            exit()
 
         params = {'nf': bool(args.includenonsignificantlogs),
                   'adf': not bool(args.excludesignificantlogs),
@@ -77,8 +1068,11 @@ if __name__ == '__main__':
 
         start_date_time = (datetime.fromisoformat(args.startdatetime)
                            .astimezone(timezone.utc))
-        end_date_time = (datetime.fromisoformat(args.enddatetime)
-                         .astimezone(timezone.utc))
+        if args.enddatetime:
+            end_date_time = (datetime.fromisoformat(args.enddatetime)
+                             .astimezone(timezone.utc))
+        elif not follow:
+            parser.error('the following arguments are required: enddatetime')
 
         while not controller:
             controller = input('Controller:')
@@ -96,22 +1090,23 @@ if __name__ == '__main__':
         api = ApiSession.get_session(controller, user, password,
                                      api_version=api_version)
 
-        print(f'Locating Virtual Service {vs_name}...')
+        print(f'Locating Virtual Services {vs_names}...')
 
-        vs_obj = api.get_object_by_name('virtualservice', name=vs_name,
-                                        tenant=tenant,
-                                        params={'fields': 'uuid'})
+        vs_list = find_virtual_services(api, tenant, vs_names)
 
-        if not vs_obj:
-            print(f'Unable to locate Virtual Service "{vs_name}"')
+        if not vs_list:
+            print(f'Unable to locate Virtual Service "{vs_names}"')
             exit()
 
+        print(f'  Found {len(vs_list)} Virtual Services.')
+
         # First, we make a dummy request for logs using the "download" option
         # which returns a CSV file from which we can extract the column headers
         # which will be the set of valid log field names as these will vary
-        # depending on software version.
+        # depending on software version. The field names are the same for
+        # all Virtual Services so this is only done once.
 
-        params['virtualservice'] = vs_obj['uuid']
+        params['virtualservice'] = vs_list[0][1]
         params['download'] = True
         params['page_size'] = 1
         params['page'] = 1
@@ -128,86 +1123,206 @@ if __name__ == '__main__':
 
         print(f'  Found {len(field_names)} fields.')
 
-        params['start'] = start_date_time.isoformat(timespec='milliseconds')
-        params['end'] = end_date_time.isoformat(timespec='milliseconds')
+        # The logs API has no way to request only specific fields, so any
+        # field selection is applied as each log entry is decoded and only
+        # the selected fields are passed to the output.
+
+        if selected_fields:
+            unknown_fields = [f for f in selected_fields
+                              if f not in field_names]
+            if unknown_fields:
+                print(f'  Unknown log fields {",".join(unknown_fields)} : '
+                      f'giving up!')
+                exit()
+            field_names = selected_fields
+            print(f'  Exporting {len(field_names)} selected fields.')
+
         params['download'] = False
         params['format'] = 'json'
         params.pop('duration', None)
+        params.pop('virtualservice', None)
 
-        # Next, we need to wait for the logs to be fully indexed.
-        # We do this by repeatedly requesting the logs for the entire
-        # requested time range but only asking for a single log entry.
-        # The Controller will return the data including a percent_remaining
-        # field which indicates the percentage of logs within the requested
-        # date range remain to be indexed. We keep looping, with a delay
-        # proportional to percent_remaining until percent_remaining == 0.
+        # Now we can iteratively retrieve all the required logs from the
+        # entire requested time range.
+        #
+        # When multiple workers are requested, the time range is split into
+        # equal slices which are retrieved concurrently, each slice with its
+        # own query_id and paging cursor into its own part file. Once all
+        # slices of an output file are complete, the parts are stitched
+        # together by Virtual Service and then newest first so the output is
+        # in the same order as a serial export. Slices of all Virtual
+        # Services share a single session and a pool of up to concurrency
+        # worker threads.
+        #
+        # Each slice first waits for its own logs to be indexed. Slices are
+        # scheduled oldest first, so older slices which are already indexed
+        # can be exported while the newest logs are still being indexed.
+        #
+        # Progress is checkpointed after every page so that if the export is
+        # interrupted it can be resumed using the --resume option.
 
-        print(':: Making sure logs have been indexed...')
+        if filterstrings:
+            params['filter'] = filterstrings
+        params['page_size'] = page_size
 
-        while True:
-            params['query_id'] = get_query_id()
-
-            r = api.get('analytics/logs', tenant=tenant, params=params)
-            if r.status_code == 200:
-                r_data = r.json()
-                percent_remaining = r_data['percent_remaining']
-                if percent_remaining == 0.0:
-                    print('  Logs are indexed')
-                    break
+        if follow:
+            if filename == '-':
+                sink = StdoutSink(field_names)
+                sinks = {vs_uuid: sink for _, vs_uuid in vs_list}
+            elif per_vs:
+                sinks = {vs_uuid: CsvSink(filename.replace('{vs}', vs_name),
+                                          field_names, size=0,
+                                          compression=compression)
+                         for vs_name, vs_uuid in vs_list}
+            else:
+                sink = CsvSink(filename, field_names, size=0,
+                               compression=compression)
+                sinks = {vs_uuid: sink for _, vs_uuid in vs_list}
+
+            print(f':: Following logs from {start_date_time:%c %Z}, '
+                  f'press Ctrl-C to stop...')
+            total_logs = follow_logs(api, tenant, params, field_names,
+                                     vs_list, sinks, start_date_time,
+                                     args.pollinterval)
+            for sink in set(sinks.values()):
+                sink.close()
+            print(f':: {total_logs} logs were retrieved')
+            print(f':: {transfer_stats.summary(total_logs)}')
+            exit()
+
+        query = {k: params.get(k) for k in ('nf', 'adf', 'udf', 'filter')}
+        query['compression'] = compression
+        query['fields'] = selected_fields
 
-                print(f'  Logs are being indexed : '
-                      f'{percent_remaining}% remaining...')
-                time.sleep(percent_remaining / 10)
+        time_slices = split_time_range(start_date_time, end_date_time,
+                                       workers)
+
+        if per_vs:
+            outputs = [(filename.replace('{vs}', vs_name),
+                        [(vs_name, vs_uuid)])
+                       for vs_name, vs_uuid in vs_list]
+        else:
+            outputs = [(filename, vs_list)]
+
+        exports = []
+        parquet_schemas = []
+
+        for output, output_vs_list in outputs:
+            checkpoint_filename = (f'{output}.checkpoint'
+                                   if checkpointed else None)
+
+            if resume and exists(checkpoint_filename):
+                checkpoint = Checkpoint.load(checkpoint_filename)
+                if (checkpoint.state['query'] != query or
+                        {s['virtualservice'] for s in checkpoint.slices} !=
+                        {vs_uuid for _, vs_uuid in output_vs_list}):
+                    print(f'Unable to resume : the checkpointed export to '
+                          f'{output} used different options')
+                    exit()
+                print(f':: Resuming export to file {output}...')
+            elif resume and exists(output):
+                print(f':: Export to file {output} is already complete')
+                continue
             else:
-                print('  Error while waiting for log indexing : giving up!')
-                exit()
+                checkpoint = Checkpoint.create(
+                    checkpoint_filename, output, query, field_names,
+                    output_vs_list, time_slices)
+                checkpoint.save()
+                print(f':: Writing to file {output}...')
+
+            if output_format == 'parquet':
+                parquet_schema = ParquetSchema(field_names)
+                parquet_schemas.append(parquet_schema)
+                open_sink = partial(ParquetSink, schema=parquet_schema)
+                stitch = partial(ParquetSink.stitch, schema=parquet_schema)
+            else:
+                open_sink = partial(CsvSink, compression=compression)
+                stitch = partial(CsvSink.stitch, field_names=field_names,
+                                 compression=compression)
+            exports.append((checkpoint, open_sink, stitch))
 
-        # Now that the logs are indexed, we can iteratively retrieve all
-        # the required logs from the entire requested time range.
+        print(f':: Retrieving {sum(len(c.slices) for c, _, _ in exports)} '
+              f'time slices with up to {concurrency} concurrent workers...')
 
-        if filterstrings:
-            params['filter'] = filterstrings
-        params['page_size'] = 10000
+        vs_stats = {}
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = []
+            for checkpoint, open_sink, _ in exports:
+                vs_slices = {}
+                for slice_state in checkpoint.slices:
+                    vs_slices.setdefault(slice_state['virtualservice'],
+                                         []).append(slice_state)
+                for n, slice_state in enumerate(checkpoint.slices):
+                    slices = vs_slices[slice_state['virtualservice']]
+                    label = (f'[{slice_state["name"]} '
+                             f'{slices.index(slice_state) + 1}/'
+                             f'{len(slices)}] '
+                             if len(vs_list) > 1 or len(slices) > 1 else '')
+                    futures.append((slice_state, executor.submit(
+                        timed_call, export_slice, api, tenant, params,
+                        checkpoint, n, open_sink, label)))
+
+            for slice_state, future in futures:
+                (slice_logs, complete), started, finished = future.result()
+                stats = vs_stats.setdefault(
+                    slice_state['name'], {'logs': 0, 'complete': True,
+                                          'started': started,
+                                          'finished': finished})
+                stats['logs'] += slice_logs
+                stats['complete'] &= complete
+                stats['started'] = min(stats['started'], started)
+                stats['finished'] = max(stats['finished'], finished)
 
         total_logs = 0
+        incomplete = False
 
-        print(f':: Writing to file {filename}...')
+        for checkpoint, _, stitch in exports:
+            output = checkpoint.state['output']
+            part_filenames = checkpoint.part_filenames()
+            slice_count = len(checkpoint.slices)
+            total_logs += sum(s['logs'] for s in checkpoint.slices)
 
-        with (open(filename, 'w', newline='', encoding='UTF-8')) as csv_file:
-            csv_writer = csv.writer(csv_file, dialect='excel')
-            csv_writer.writerow(field_names)
+            if not all(s['complete'] for s in checkpoint.slices):
+                incomplete = True
+                if not checkpoint.filename and slice_count > 1 and \
+                        output != devnull:
+                    for part_filename in part_filenames:
+                        remove(part_filename)
+                continue
 
-            while True:
-                print(f':: Retrieving up to 10,000 logs from '
-                      f'{start_date_time:%c %Z} to '
-                      f'{end_date_time:%c %Z}...')
-
-                params['query_id'] = get_query_id()
-                params['end'] = end_date_time.isoformat(timespec='milliseconds')
-
-                r = api.get('analytics/logs', tenant=tenant, params=params)
-                if r.status_code == 200:
-                    r_data = r.json()
-                    results = r_data['results']
-                    res_count = len(results)
-
-                    if res_count > 0:
-                        print(f'  Got {res_count} logs')
-                        for res in results:
-                            vals = ["'" + str(v) if v is not None and
-                                    str(v).lstrip().startswith(('+', '-', '='))
-                                    else v for v in [res.get(f, None)
-                                                     for f in field_names]]
-                            csv_writer.writerow(vals)
-                        total_logs += res_count
-                        last_entry = results[-1]['report_timestamp']
-                        end_date_time = datetime.fromisoformat(last_entry)
-                    else:
-                        print(':: No more logs available')
-                        break
-                else:
-                    print(f':: Error {r.status_code} occurred : giving up!')
-                    break
-        print(f':: {total_logs} logs were retrieved')
+            if slice_count > 1 and output != devnull:
+                stitch(output, part_filenames)
+                for part_filename in part_filenames:
+                    remove(part_filename)
+
+            checkpoint.remove()
+
+        if len(vs_stats) > 1:
+            print(tabulate([[vs_name, stats['logs'],
+                             f'{stats["finished"] - stats["started"]:.1f}s',
+                             'Complete' if stats['complete']
+                             else 'Incomplete']
+                            for vs_name, stats in vs_stats.items()],
+                           headers=['Virtual Service', 'Logs', 'Elapsed',
+                                    'Status'],
+                           tablefmt='outline'))
+
+        widened = {field: value_type for schema in parquet_schemas
+                   for field, value_type in schema.widened.items()}
+        if widened:
+            print(':: Columns with values that did not match their inferred '
+                  'type were widened: ' +
+                  ', '.join(f'{field} ({value_type})'
+                            for field, value_type in widened.items()))
+
+        if incomplete:
+            print(f':: {total_logs} logs were retrieved but the export is '
+                  f'incomplete')
+            if checkpointed:
+                print('   Re-run with --resume to continue')
+        else:
+            print(f':: {total_logs} logs were retrieved')
+        print(f':: {transfer_stats.summary(total_logs)}')
     else:
         parser.print_help()